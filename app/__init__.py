@@ -1,9 +1,11 @@
+import os
+
 from flask import Flask
 from flask import json
 
 app = Flask(__name__)
 #app.config.from_object( 'config')
-app.config.from_json( 'config.json')
+app.config.from_json( os.environ.get( 'MAPACCOUNT_CONFIG', 'config.json' ) )
 
 from app import views
 from app import mapaccount
@@ -0,0 +1,68 @@
+# -*- coding: UTF-8 -*-
+
+import time
+import threading
+
+from contextlib import contextmanager
+
+class DeadlineExceeded( Exception ):
+    """
+    raised when the current request has used up its time budget
+    """
+    pass
+
+class Deadline( object ):
+    def __init__( self, seconds ):
+        self.seconds = seconds
+        self.expires = time.time() + seconds
+
+    def remaining( self ):
+        return self.expires - time.time()
+
+    def expired( self ):
+        return self.remaining() <= 0
+
+_local = threading.local()
+
+def current():
+    """
+    returns the Deadline in force on this thread, or None
+    """
+    return getattr( _local, 'deadline', None )
+
+@contextmanager
+def use( deadline ):
+    """
+    puts deadline (a Deadline or None) in force on this thread for the
+    duration of the block
+    """
+    previous = current()
+    _local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _local.deadline = previous
+
+def check():
+    """
+    raises DeadlineExceeded if the deadline in force has passed
+    """
+    d = current()
+    if d is not None and d.expired():
+        raise DeadlineExceeded(
+            "request exceeded its %s second budget" % d.seconds
+        )
+
+def timeout( default=None ):
+    """
+    returns the timeout to give a blocking call: default, cut down to
+    what is left of the deadline in force.  Raises DeadlineExceeded if
+    nothing is left.
+    """
+    d = current()
+    if d is None:
+        return default
+    check()
+    if default is None or default < 0:
+        return d.remaining()
+    return min( default, d.remaining() )
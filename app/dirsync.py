@@ -0,0 +1,302 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import time
+import logging
+import tempfile
+import cPickle as pickle
+
+from collections import OrderedDict
+
+import ldap
+
+from ldap.controls import LDAPControl
+
+from ldappool import paged_search
+
+VERSION = 1
+# returns deleted objects (tombstones) to a search
+SHOW_DELETED = '1.2.840.113556.1.4.417'
+SYNC_ATTRS = [ 'objectGUID', 'uSNChanged' ]
+
+def under( dn, base ):
+    dn = dn.lower()
+    base = base.lower()
+    return dn == base or dn.endswith( "," + base )
+
+def lookup( directory, base, dn ):
+    """
+    the entries a SCOPE_BASE person search for dn would return, answered
+    from directory (lower-cased DN -> ( dn, attrs )), or None if dn lies
+    outside base and has to be searched for.  Each call hands out fresh
+    attribute lists, as a new search would.
+    """
+    try:
+        found, attrs = directory[ dn.lower() ]
+    except KeyError:
+        if under( dn, base ):
+            # not a person, or the search would have found it
+            return []
+        return None
+    return [ ( found, dict( ( a, list( v ) ) for a, v in attrs.iteritems() ) ) ]
+
+class DirectorySync( object ):
+    """
+    local copy of the entries matching `filterstr` under `base`, kept in
+    `path` between runs.
+
+    the first run (and any run with full set, or once the last full pull
+    is older than `full_interval` seconds) reads everything.  Later runs
+    only read entries whose uSNChanged is past the watermark the last
+    run recorded, plus deleted users, and patch the copy- the
+    directReports backlinks included, since a manager's own entry does
+    not change when a report comes or goes.
+
+    USNs are per domain controller, so talking to a different one, or
+    asking for different attributes, also forces a full pull.  Each
+    periodic full pull is compared with the copy it replaces and any
+    difference logged.
+    """
+    def __init__(
+        self, path, base, filterstr, attrlist, page_size=500,
+        full_interval=604800
+    ):
+        self.path = path
+        self.base = base
+        self.filterstr = filterstr
+        self.attrlist = list( attrlist )
+        self.page_size = page_size
+        self.full_interval = full_interval
+        self.state = None
+
+    def load( self ):
+        try:
+            f = open( self.path, 'rb' )
+        except IOError:
+            return None
+        try:
+            state = pickle.load( f )
+        except ( pickle.UnpicklingError, EOFError, AttributeError,
+                 ImportError, IndexError, KeyError, ValueError ), e:
+            logging.warning( "ignoring unreadable sync state %s: %s", self.path, e )
+            return None
+        finally:
+            f.close()
+        if state.get( 'version' ) != VERSION:
+            return None
+        return state
+
+    def save( self ):
+        directory, name = os.path.split( os.path.abspath( self.path ) )
+        fd, tmp = tempfile.mkstemp( dir=directory, prefix='.' + name + '.' )
+        try:
+            f = os.fdopen( fd, 'wb' )
+            pickle.dump( self.state, f, pickle.HIGHEST_PROTOCOL )
+            f.close()
+            os.rename( tmp, self.path )
+        except:
+            os.unlink( tmp )
+            raise
+
+    def _root( self, l ):
+        entries = l.search_s(
+            '', ldap.SCOPE_BASE, '(objectClass=*)',
+            [ 'highestCommittedUSN', 'dsServiceName', 'defaultNamingContext' ]
+        )
+        attrs = entries[0][1]
+        return (
+            int( attrs['highestCommittedUSN'][0] ),
+            attrs['dsServiceName'][0],
+            attrs['defaultNamingContext'][0]
+        )
+
+    def _read( self, l, filterstr, base=None, serverctrls=None ):
+        # tombstone searches need a control paged_search does not take;
+        # they only return what was deleted since the last run
+        if serverctrls is None:
+            return paged_search(
+                l, base or self.base, ldap.SCOPE_SUBTREE, filterstr,
+                self.attrlist + SYNC_ATTRS, self.page_size
+            )
+        msgid = l.search_ext(
+            base or self.base, ldap.SCOPE_SUBTREE, filterstr,
+            SYNC_ATTRS, serverctrls=serverctrls
+        )
+        rtype, entries = l.result( msgid, 1, 60 )
+        return [ ( dn, attrs ) for dn, attrs in entries if dn is not None ]
+
+    def _full( self, l, usn, server ):
+        entries = OrderedDict()
+        for dn, attrs in self._read( l, self.filterstr ):
+            entries[ dn.lower() ] = ( dn, attrs )
+        return {
+            'version': VERSION,
+            'server': server,
+            'base': self.base,
+            'filter': self.filterstr,
+            'attrs': self.attrlist,
+            'usn': usn,
+            'full': time.time(),
+            'entries': entries,
+        }
+
+    def _guids( self ):
+        return dict(
+            ( attrs['objectGUID'][0], key )
+            for key, ( dn, attrs ) in self.state['entries'].iteritems()
+            if 'objectGUID' in attrs
+        )
+
+    def _unlink( self, key, deleted=False ):
+        # drop key's entry and its DN from its manager's directReports;
+        # a deleted manager is also gone from its reports' manager
+        entries = self.state['entries']
+        dn, attrs = entries.pop( key )
+        self._move_report( dn, attrs.get( 'manager', [ None ] )[0], None )
+        if deleted:
+            for report in attrs.get( 'directReports', [] ):
+                if report.lower() in entries:
+                    entries[ report.lower() ][1].pop( 'manager', None )
+
+    def _relink( self, dn, attrs ):
+        # the server sends a changed entry's directReports as they are
+        # now; its reports' manager may still hold a DN it was renamed from
+        entries = self.state['entries']
+        for report in attrs.get( 'directReports', [] ):
+            if report.lower() in entries:
+                entries[ report.lower() ][1][ 'manager' ] = [ dn ]
+
+    def _move_report( self, dn, old, new ):
+        entries = self.state['entries']
+        if old is not None and old.lower() in entries:
+            reports = entries[ old.lower() ][1].get( 'directReports', [] )
+            for i, report in enumerate( reports ):
+                if report.lower() == dn.lower():
+                    del reports[i]
+                    break
+        if new is not None and new.lower() in entries:
+            reports = entries[ new.lower() ][1].setdefault( 'directReports', [] )
+            if dn.lower() not in [ report.lower() for report in reports ]:
+                reports.append( dn )
+
+    def _incremental( self, l, usn, naming_context ):
+        entries = self.state['entries']
+        since = "(uSNChanged>=%d)" % ( self.state['usn'] + 1 )
+        guids = self._guids()
+        changed = 0
+
+        # entries that were added, renamed, moved or changed
+        for dn, attrs in self._read( l, "(&" + self.filterstr + since + ")" ):
+            key = dn.lower()
+            old = guids.get( attrs.get( 'objectGUID', [ None ] )[0] )
+            old_manager = None
+            if old is not None and old != key:
+                # renamed- off the old manager's list under the old DN
+                self._unlink( old )
+            elif key in entries:
+                old_manager = entries[ key ][1].get( 'manager', [ None ] )[0]
+            entries[ key ] = ( dn, attrs )
+            self._relink( dn, attrs )
+            # the manager's entry has not changed, only its backlinks
+            self._move_report(
+                dn, old_manager, attrs.get( 'manager', [ None ] )[0]
+            )
+            changed += 1
+
+        # entries that changed so they no longer match
+        for dn, attrs in self._read(
+            l, "(&(objectClass=user)(!" + self.filterstr + ")" + since + ")"
+        ):
+            if dn.lower() in entries:
+                self._unlink( dn.lower() )
+                changed += 1
+
+        # deleted users, which only their GUID ties to the copy
+        guids = self._guids()
+        for dn, attrs in self._read(
+            l, "(&(objectClass=user)(isDeleted=TRUE)" + since + ")",
+            base=naming_context,
+            serverctrls=[ LDAPControl( SHOW_DELETED, True, None ) ]
+        ):
+            key = guids.get( attrs.get( 'objectGUID', [ None ] )[0] )
+            if key is not None and key in entries:
+                self._unlink( key, deleted=True )
+                changed += 1
+
+        self.state['usn'] = usn
+        return changed
+
+    def check( self, fresh ):
+        """
+        logs how the copy differs from fresh, a full pull's state, and
+        returns the number of entries that differ
+        """
+        ours = self.state['entries']
+        theirs = fresh['entries']
+        differ = 0
+        for key in set( ours ) | set( theirs ):
+            if key not in ours or key not in theirs:
+                logging.warning(
+                    "sync check: %s only in the %s copy", key,
+                    'synced' if key in ours else 'full'
+                )
+                differ += 1
+                continue
+            a, b = ours[ key ][1], theirs[ key ][1]
+            for attr in set( a ) | set( b ):
+                if attr in SYNC_ATTRS:
+                    continue
+                x, y = a.get( attr, [] ), b.get( attr, [] )
+                if attr == 'directReports':
+                    # the order of backlinks is the server's to choose
+                    x = sorted( v.lower() for v in x )
+                    y = sorted( v.lower() for v in y )
+                if x != y:
+                    logging.warning(
+                        "sync check: %s differs in %s", key, attr
+                    )
+                    differ += 1
+                    break
+        return differ
+
+    def sync( self, l, full=False ):
+        """
+        brings the copy up to date and saves it; returns the entries as
+        an ordered dict of lower-cased DN -> ( dn, attrs )
+        """
+        usn, server, naming_context = self._root( l )
+        self.state = self.load()
+        state = self.state
+        reason = None
+        if full:
+            reason = 'requested'
+        elif state is None:
+            reason = 'no saved state'
+        elif ( state['server'], state['base'], state['filter'],
+               state['attrs'] ) != (
+                 server, self.base, self.filterstr, self.attrlist ):
+            reason = 'server or search changed'
+        elif time.time() - state['full'] > self.full_interval:
+            reason = 'periodic'
+
+        if reason is None:
+            changed = self._incremental( l, usn, naming_context )
+            logging.info(
+                "incremental sync: %s changes up to USN %s", changed, usn
+            )
+        else:
+            fresh = self._full( l, usn, server )
+            if reason == 'periodic':
+                differ = self.check( fresh )
+                if differ:
+                    logging.warning(
+                        "sync check: %s entries differed from a full pull",
+                        differ
+                    )
+            self.state = fresh
+            logging.info(
+                "full sync (%s): %s entries up to USN %s",
+                reason, len( fresh['entries'] ), usn
+            )
+        self.save()
+        return self.state['entries']
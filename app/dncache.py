@@ -0,0 +1,76 @@
+# -*- coding: UTF-8 -*-
+
+import time
+import threading
+
+from collections import OrderedDict
+
+class DNCache( object ):
+    """
+    process-wide, thread-safe cache of directory attributes keyed by DN.
+
+    entries expire `ttl` seconds after they were stored and the least
+    recently used entry is evicted once more than `size` are held.
+    """
+    def __init__( self, size=10000, ttl=300 ):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key( self, dn ):
+        # AD compares DNs case-insensitively
+        return dn.lower()
+
+    def get( self, dn ):
+        """
+        returns the cached attributes for dn, or None on a miss
+        """
+        key = self._key( dn )
+        with self._lock:
+            try:
+                stored, attrs = self._entries.pop( key )
+            except KeyError:
+                self.misses += 1
+                return None
+            if time.time() - stored > self.ttl:
+                self.misses += 1
+                return None
+            # re-insert to mark as most recently used
+            self._entries[ key ] = ( stored, attrs )
+            self.hits += 1
+            return attrs
+
+    def contains( self, dn ):
+        """
+        returns True if dn has a live entry, without touching the LRU
+        order or the hit/miss counters
+        """
+        with self._lock:
+            try:
+                stored, attrs = self._entries[ self._key( dn ) ]
+            except KeyError:
+                return False
+            return time.time() - stored <= self.ttl
+
+    def put( self, dn, attrs ):
+        key = self._key( dn )
+        with self._lock:
+            self._entries.pop( key, None )
+            self._entries[ key ] = ( time.time(), attrs )
+            while len( self._entries ) > self.size:
+                self._entries.popitem( last=False )
+
+    def clear( self ):
+        with self._lock:
+            self._entries.clear()
+
+    def stats( self ):
+        with self._lock:
+            return {
+                'size': len( self._entries ),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
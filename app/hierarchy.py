@@ -0,0 +1,150 @@
+# -*- coding: UTF-8 -*-
+
+class Hierarchy( object ):
+    """
+    the org chart numbered by one depth-first walk from the top.  Each
+    person gets the interval [ first, last ) of walk positions covering
+    themselves and everyone under them, so "is X under Y" is two
+    comparisons, and `owner` holds the nearest PI above each person.
+
+    built from ( dn, username, manager dn, is_pi ) tuples; DNs are
+    compared lower-cased.  People whose manager is unknown (or who sit
+    on a management loop) start a tree of their own.
+    """
+    def __init__( self, people ):
+        self.usernames = {}
+        self.dns = {}
+        self.pis = set()
+        managers = {}
+        for dn, username, manager, is_pi in people:
+            dn = dn.lower()
+            self.usernames[ dn ] = username
+            if username:
+                self.dns[ username.lower() ] = dn
+            if is_pi:
+                self.pis.add( dn )
+            managers[ dn ] = manager.lower() if manager else None
+
+        children = {}
+        roots = []
+        for dn, manager in managers.iteritems():
+            if manager is not None and manager != dn and manager in managers:
+                children.setdefault( manager, [] ).append( dn )
+            else:
+                roots.append( dn )
+
+        self.order = []
+        self.first = {}
+        self.last = {}
+        self.owner = {}
+        for dn in sorted( roots ):
+            self._walk( dn, children )
+        # nobody on a management loop is reachable from a root
+        for dn in sorted( managers ):
+            if dn not in self.first:
+                self._walk( dn, children )
+
+    def _walk( self, root, children ):
+        stack = [ ( root, None, False ) ]
+        while stack:
+            dn, owner, done = stack.pop()
+            if done:
+                self.last[ dn ] = len( self.order )
+                continue
+            if dn in self.first:
+                continue
+            self.first[ dn ] = len( self.order )
+            self.order.append( dn )
+            self.owner[ dn ] = owner
+            stack.append( ( dn, None, True ) )
+            if dn in self.pis:
+                owner = dn
+            for child in sorted( children.get( dn, () ), reverse=True ):
+                stack.append( ( child, owner, False ) )
+
+    @classmethod
+    def from_entries( cls, entries, pi_titles ):
+        """
+        builds the hierarchy from ( dn, attrs ) search results
+        """
+        def people():
+            for dn, attrs in entries:
+                if dn is None:
+                    continue
+                yield (
+                    dn,
+                    attrs.get( 'sAMAccountName', [ None ] )[0],
+                    attrs.get( 'manager', [ None ] )[0],
+                    attrs.get( 'title', [ None ] )[0] in pi_titles
+                )
+        return cls( people() )
+
+    def __contains__( self, dn ):
+        return dn.lower() in self.first
+
+    def __len__( self ):
+        return len( self.order )
+
+    def dn( self, username ):
+        """
+        returns the DN for username, or None
+        """
+        return self.dns.get( username.lower() )
+
+    def username( self, dn ):
+        return self.usernames.get( dn.lower() )
+
+    def is_under( self, dn, ancestor ):
+        """
+        True if dn is anywhere below ancestor
+        """
+        try:
+            a = ancestor.lower()
+            return self.first[ a ] < self.first[ dn.lower() ] < self.last[ a ]
+        except KeyError:
+            return False
+
+    def pi_of( self, dn ):
+        """
+        returns the DN of the nearest PI above dn, or None
+        """
+        return self.owner.get( dn.lower() )
+
+    def in_reports( self, dn, of ):
+        """
+        True if dn is among of's reports as the scripts count them:
+        below of with no PI in between (a PI directly below counts, the
+        PI's own people do not)
+        """
+        if not self.is_under( dn, of ):
+            return False
+        owner = self.pi_of( dn )
+        return owner is None or self.first[ owner ] <= self.first[ of.lower() ]
+
+    def subtree( self, dn ):
+        """
+        returns the DNs of everyone below dn, in walk order
+        """
+        dn = dn.lower()
+        if dn not in self.first:
+            return []
+        return self.order[ self.first[ dn ] + 1:self.last[ dn ] ]
+
+    def reports( self, dn ):
+        """
+        returns the DNs of dn's reports (see in_reports), in walk order
+        """
+        dn = dn.lower()
+        if dn not in self.first:
+            return []
+        found = []
+        i, end = self.first[ dn ] + 1, self.last[ dn ]
+        while i < end:
+            report = self.order[i]
+            found.append( report )
+            if report in self.pis:
+                # skip over the PI's own people
+                i = self.last[ report ]
+            else:
+                i += 1
+        return found
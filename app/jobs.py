@@ -0,0 +1,280 @@
+# -*- coding: UTF-8 -*-
+
+import json
+import time
+import uuid
+import Queue
+import sqlite3
+import logging
+import threading
+
+class QueueFull( Exception ):
+    """
+    raised by submit() when the queue already holds `size` jobs
+    """
+    pass
+
+class Job( object ):
+    """
+    one submitted list of uids.  `state` moves from 'queued' through
+    'running' to 'done' or 'failed'; `done` counts the uids resolved so
+    far.
+    """
+    def __init__( self, uids, id=None ):
+        self.id = id or uuid.uuid4().hex
+        self.uids = uids
+        self.state = 'queued'
+        self.done = 0
+        self.results = {}
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def status( self ):
+        status = {
+            'id': self.id,
+            'state': self.state,
+            'total': len( self.uids ),
+            'done': self.done,
+        }
+        if self.error is not None:
+            status[ 'error' ] = self.error
+        return status
+
+class JobStore( object ):
+    """
+    job state in a SQLite file every worker process opens, so a job
+    polled on a process other than the one running it is still found.
+    Progress is saved after each chunk; results once the job finishes.
+    """
+    SCHEMA = (
+        "create table if not exists jobs ( id text primary key, "
+        "uids text, state text, done integer, results text, error text, "
+        "created real, finished real )"
+    )
+
+    def __init__( self, path ):
+        self.path = path
+        self._local = threading.local()
+
+    def _db( self ):
+        db = getattr( self._local, 'db', None )
+        if db is None:
+            db = sqlite3.connect( self.path, timeout=30 )
+            db.execute( self.SCHEMA )
+            db.commit()
+            self._local.db = db
+        return db
+
+    def save( self, job, results=False ):
+        db = self._db()
+        with db:
+            db.execute(
+                "insert or replace into jobs values ( ?, ?, ?, ?, ?, ?, ?, ? )",
+                (
+                    job.id, json.dumps( job.uids ), job.state, job.done,
+                    json.dumps( job.results ) if results else None,
+                    job.error, job.created, job.finished
+                )
+            )
+
+    def load( self, id ):
+        """
+        returns the Job saved under id, or None
+        """
+        row = self._db().execute(
+            "select uids, state, done, results, error, created, finished "
+            "from jobs where id = ?", ( id, )
+        ).fetchone()
+        if row is None:
+            return None
+        uids, state, done, results, error, created, finished = row
+        job = Job( json.loads( uids ), id )
+        job.state = state
+        job.done = done
+        job.results = json.loads( results ) if results else {}
+        job.error = error
+        job.created = created
+        job.finished = finished
+        return job
+
+    def delete( self, id ):
+        db = self._db()
+        with db:
+            db.execute( "delete from jobs where id = ?", ( id, ) )
+
+    def expire( self, before ):
+        db = self._db()
+        with db:
+            db.execute(
+                "delete from jobs where finished is not null and finished < ?",
+                ( before, )
+            )
+
+    def stats( self ):
+        return dict( self._db().execute(
+            "select state, count(*) from jobs group by state"
+        ) )
+
+class JobQueue( object ):
+    """
+    bounded queue of Jobs served by `workers` threads.  Each job is fed
+    to `fn` `chunk` uids at a time; fn returns a dict of results that is
+    merged into the job.  Finished jobs are dropped `ttl` seconds after
+    they finish.
+
+    jobs are held in this process's memory, so with more than one
+    worker process a `store` (JobStore) has to be given for a poll to
+    find a job another process is running.
+    """
+    def __init__(
+        self, fn, workers=2, size=20, chunk=25, ttl=3600, store=None
+    ):
+        self.fn = fn
+        self.workers = workers
+        self.chunk = chunk
+        self.ttl = ttl
+        self.store = store
+        self._queue = Queue.Queue( size )
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _run( self ):
+        while True:
+            job = self._queue.get()
+            job.state = 'running'
+            try:
+                self._save( job )
+                for i in range( 0, len( job.uids ), self.chunk ):
+                    todo = job.uids[ i:i + self.chunk ]
+                    job.results.update( self.fn( todo ) )
+                    job.done += len( todo )
+                    self._save( job )
+                job.state = 'done'
+            except Exception, e:
+                logging.exception( "job %s failed", job.id )
+                job.error = str( e )
+                job.state = 'failed'
+            job.finished = time.time()
+            self._save( job, results=True )
+
+    def _save( self, job, results=False ):
+        # a job still runs (and is found here) if the store cannot be
+        # written; only polls on other processes miss it
+        if self.store is None:
+            return
+        try:
+            self.store.save( job, results )
+        except sqlite3.Error, e:
+            logging.error( "unable to save job %s: %s", job.id, e )
+
+    def start( self ):
+        with self._lock:
+            if self._threads:
+                return
+            for n in range( self.workers ):
+                t = threading.Thread( target=self._run, name='job-%s' % n )
+                t.daemon = True
+                t.start()
+                self._threads.append( t )
+
+    def _expire( self ):
+        now = time.time()
+        with self._lock:
+            for id, job in self._jobs.items():
+                if job.finished is not None and now - job.finished > self.ttl:
+                    del self._jobs[ id ]
+        if self.store is not None:
+            try:
+                self.store.expire( now - self.ttl )
+            except sqlite3.Error, e:
+                logging.error( "unable to expire stored jobs: %s", e )
+
+    def submit( self, uids ):
+        """
+        queues a Job for uids and returns it, or raises QueueFull
+        """
+        self.start()
+        self._expire()
+        job = Job( uids )
+        with self._lock:
+            self._jobs[ job.id ] = job
+        self._save( job )
+        try:
+            self._queue.put_nowait( job )
+        except Queue.Full:
+            with self._lock:
+                del self._jobs[ job.id ]
+            if self.store is not None:
+                try:
+                    self.store.delete( job.id )
+                except sqlite3.Error, e:
+                    logging.error( "unable to drop job %s: %s", job.id, e )
+            raise QueueFull(
+                "%s jobs already waiting" % self._queue.maxsize
+            )
+        return job
+
+    def get( self, id ):
+        """
+        returns the Job with id, or None if it is unknown or expired.
+        A job this process is not running is looked for in the store.
+        """
+        self._expire()
+        job = self._jobs.get( id )
+        if job is None and self.store is not None:
+            job = self.store.load( id )
+        return job
+
+    def depth( self ):
+        return self._queue.qsize()
+
+    def stats( self ):
+        if self.store is not None:
+            return self.store.stats()
+        counts = {}
+        with self._lock:
+            for job in self._jobs.values():
+                counts[ job.state ] = counts.get( job.state, 0 ) + 1
+        return counts
+
+class WorkerPool( object ):
+    """
+    `workers` threads shared by every caller, running the functions
+    handed to submit() in the order they were submitted.  Callers keep
+    their own work bounded; the queue is not.
+    """
+    def __init__( self, workers=8, name='worker' ):
+        self.workers = workers
+        self.name = name
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _run( self ):
+        while True:
+            fn, args = self._queue.get()
+            try:
+                fn( *args )
+            except Exception:
+                logging.exception( "%s task failed", self.name )
+
+    def start( self ):
+        with self._lock:
+            if self._threads:
+                return
+            for n in range( self.workers ):
+                t = threading.Thread(
+                    target=self._run, name='%s-%s' % ( self.name, n )
+                )
+                t.daemon = True
+                t.start()
+                self._threads.append( t )
+
+    def submit( self, fn, *args ):
+        self.start()
+        self._queue.put( ( fn, args ) )
+
+    def depth( self ):
+        return self._queue.qsize()
@@ -0,0 +1,470 @@
+# -*- coding: UTF-8 -*-
+
+import sys
+import math
+import time
+import Queue
+import threading
+import logging
+
+import ldap
+
+from ldap.controls import SimplePagedResultsControl
+from contextlib import contextmanager
+from collections import deque
+
+from metrics import Counter
+
+hedged = Counter(
+    'mapaccount_ldap_hedged_total',
+    'searches duplicated to a second server, by which answered first',
+    labels=( 'winner', )
+)
+
+class PoolTimeout( Exception ):
+    """
+    raised when no pooled connection becomes free within the pool timeout
+    """
+    pass
+
+class _PrimaryFailed( Exception ):
+    """
+    carries an error from a hedged search's own server out of the hedge
+    server's connection, so the hedge server is not blamed for it
+    """
+    def __init__( self, error ):
+        Exception.__init__( self )
+        self.error = error
+
+class PooledConnection( object ):
+    """
+    a bound LDAP connection along with the bookkeeping the pool needs
+    """
+    def __init__( self, handle ):
+        self.handle = handle
+        self.created = time.time()
+        self.last_used = self.created
+
+    def close( self ):
+        try:
+            self.handle.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+class LDAPPool( object ):
+    """
+    bounded, thread-safe pool of bound LDAP connections.
+
+    connections are created lazily up to `size`, handed out LIFO so the
+    warmest connection is reused, recycled once older than `max_age`
+    seconds, and health-checked with a whoami when they have sat idle
+    longer than `check_interval` seconds.  A connection that fails its
+    check (or raises SERVER_DOWN while in use) is rebound from scratch.
+    """
+    def __init__(
+        self, uri, binddn, bindpw, size=4, timeout=10,
+        max_age=600, check_interval=30, network_timeout=10,
+        initialize=ldap.initialize
+    ):
+        self.uri = uri
+        self.initialize = initialize
+        self.binddn = binddn
+        self.bindpw = bindpw
+        self.size = size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.network_timeout = network_timeout
+
+        self._idle = Queue.LifoQueue( size )
+        self._lock = threading.Lock()
+        self._created = 0
+
+    def _connect( self ):
+        logging.debug( "opening new pooled connection to %s", self.uri )
+        l = self.initialize( self.uri )
+        l.set_option( ldap.OPT_REFERRALS, 0 )
+        l.set_option( ldap.OPT_NETWORK_TIMEOUT, self.network_timeout )
+        l.simple_bind_s( self.binddn, self.bindpw )
+        return PooledConnection( l )
+
+    def _healthy( self, conn ):
+        now = time.time()
+        if now - conn.created > self.max_age:
+            logging.debug( "recycling pooled connection past max age" )
+            return False
+        if now - conn.last_used > self.check_interval:
+            try:
+                conn.handle.whoami_s()
+            except ldap.LDAPError, e:
+                logging.debug( "pooled connection failed health check: %s", e )
+                return False
+        return True
+
+    def acquire( self, block=True ):
+        """
+        returns a healthy PooledConnection, blocking up to `timeout`
+        seconds when every connection is in use- or, without `block`,
+        raising PoolTimeout straight away.
+        """
+        create = False
+        try:
+            conn = self._idle.get_nowait()
+        except Queue.Empty:
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    create = True
+            if not create:
+                if not block:
+                    raise PoolTimeout( "no LDAP connection free" )
+                try:
+                    conn = self._idle.get( True, self.timeout )
+                except Queue.Empty:
+                    raise PoolTimeout(
+                        "no LDAP connection free after %s seconds" %
+                        self.timeout
+                    )
+
+        if create or not self._healthy( conn ):
+            if not create:
+                conn.close()
+            try:
+                conn = self._connect()
+            except:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        return conn
+
+    def release( self, conn, discard=False ):
+        """
+        returns a connection to the pool, or drops it if `discard` is set
+        """
+        if discard:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+
+        conn.last_used = time.time()
+        self._idle.put_nowait( conn )
+
+    @contextmanager
+    def connection( self ):
+        """
+        context manager yielding a bound ldap handle from the pool
+        """
+        conn = self.acquire()
+        discard = False
+        try:
+            yield conn.handle
+        except ( ldap.SERVER_DOWN, ldap.CONNECT_ERROR ):
+            discard = True
+            raise
+        finally:
+            self.release( conn, discard )
+
+    def close( self ):
+        """
+        unbinds every idle connection
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            self.release( conn, discard=True )
+
+class ServerSelector( object ):
+    """
+    tracks an exponentially weighted moving average of result latency
+    for each server, plus a window of recent samples for percentiles.
+    A server that fails is ejected (ranked last) for `eject` seconds.
+    """
+    def __init__( self, servers, alpha=0.3, eject=30, window=100,
+                  min_samples=20 ):
+        self.servers = list( servers )
+        self.alpha = alpha
+        self.eject_for = eject
+        self.min_samples = min_samples
+        self._ewma = dict( ( s, None ) for s in self.servers )
+        self._samples = dict( ( s, deque( maxlen=window ) ) for s in self.servers )
+        self._ejected = dict( ( s, 0 ) for s in self.servers )
+        self._lock = threading.Lock()
+
+    def record( self, server, seconds ):
+        with self._lock:
+            old = self._ewma[ server ]
+            if old is None:
+                self._ewma[ server ] = seconds
+            else:
+                self._ewma[ server ] = (
+                    self.alpha * seconds + ( 1 - self.alpha ) * old
+                )
+            self._samples[ server ].append( seconds )
+
+    def eject( self, server ):
+        logging.warning(
+            "ejecting LDAP server %s for %s seconds", server, self.eject_for
+        )
+        with self._lock:
+            self._ejected[ server ] = time.time() + self.eject_for
+
+    def ranked( self, exclude=(), healthy_only=False ):
+        """
+        returns servers best first: healthy ones by EWMA (unmeasured
+        ones first, so they get measured), then ejected ones by how
+        soon they return
+        """
+        now = time.time()
+        with self._lock:
+            healthy = [
+                s for s in self.servers
+                if s not in exclude and self._ejected[ s ] <= now
+            ]
+            healthy.sort( key=lambda s: self._ewma[ s ] or 0 )
+            if healthy_only:
+                return healthy
+            ejected = [
+                s for s in self.servers
+                if s not in exclude and self._ejected[ s ] > now
+            ]
+            ejected.sort( key=lambda s: self._ejected[ s ] )
+        return healthy + ejected
+
+    def percentile( self, server, pct ):
+        """
+        returns the pct'th percentile of server's recent latencies, or
+        None until there are `min_samples` of them
+        """
+        with self._lock:
+            samples = sorted( self._samples[ server ] )
+        if len( samples ) < self.min_samples:
+            return None
+        return samples[ max( 0, int( math.ceil( pct / 100.0 * len( samples ) ) ) - 1 ) ]
+
+    def stats( self ):
+        now = time.time()
+        with self._lock:
+            return dict(
+                ( s, {
+                    'ewma': self._ewma[ s ],
+                    'ejected': self._ejected[ s ] > now,
+                } ) for s in self.servers
+            )
+
+class LDAPServers( object ):
+    """
+    one LDAPPool per server, with each connection taken from the server
+    that has had the best recent latency.  A server whose connections
+    fail is ejected for a while.
+
+    with `hedge_percentile` set, a search still unanswered after that
+    percentile of its server's recent latency is sent again to the next
+    best server, and whichever answers first is used.
+    """
+    def __init__(
+        self, uris, binddn, bindpw, eject=30, hedge_percentile=None,
+        **pool_args
+    ):
+        if isinstance( uris, basestring ):
+            uris = [ uris ]
+        self.selector = ServerSelector( uris, eject=eject )
+        self.pools = dict(
+            ( uri, LDAPPool( uri, binddn, bindpw, **pool_args ) )
+            for uri in uris
+        )
+        self.hedge_percentile = hedge_percentile
+
+    def hedge_after( self, server ):
+        """
+        returns how long a search on server may run before it is hedged,
+        or None if it should not be
+        """
+        if self.hedge_percentile is None or len( self.pools ) < 2:
+            return None
+        return self.selector.percentile( server, self.hedge_percentile )
+
+    @contextmanager
+    def connection( self, exclude=(), healthy_only=False, block=True ):
+        """
+        context manager yielding a RoutedConnection to the best server
+        that will take a connection.  Without `block`, a server with no
+        connection free right now is passed over, and PoolTimeout is
+        raised if every server is busy.
+        """
+        servers = self.selector.ranked( exclude, healthy_only )
+        if not servers:
+            raise ldap.SERVER_DOWN( { 'desc': 'no LDAP server available' } )
+        for server in servers:
+            try:
+                conn = self.pools[ server ].acquire( block )
+                break
+            except ( ldap.SERVER_DOWN, ldap.CONNECT_ERROR ):
+                self.selector.eject( server )
+                if server == servers[-1]:
+                    raise
+            except PoolTimeout:
+                if block or server == servers[-1]:
+                    raise
+
+        discard = False
+        try:
+            yield RoutedConnection( self, server, conn.handle )
+        except ( ldap.SERVER_DOWN, ldap.CONNECT_ERROR ):
+            discard = True
+            self.selector.eject( server )
+            raise
+        finally:
+            self.pools[ server ].release( conn, discard )
+
+    def close( self ):
+        for pool in self.pools.values():
+            pool.close()
+
+class RoutedConnection( object ):
+    """
+    proxy for a pooled ldap handle that feeds the result latency of
+    plain searches back to the ServerSelector and hedges slow ones.
+    search_ext and result3 pass straight through: controls (paging
+    cookies) tie them to one server, and a page of a bulk read says
+    nothing about how fast a plain search will be.
+    """
+    def __init__( self, servers, server, handle ):
+        self._servers = servers
+        self._handle = handle
+        self._pending = {}
+        self.server = server
+
+    def __getattr__( self, name ):
+        return getattr( self._handle, name )
+
+    def search(
+        self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+        attrsonly=0
+    ):
+        args = ( base, scope, filterstr, attrlist, attrsonly )
+        msgid = self._handle.search( *args )
+        self._pending[ msgid ] = ( args, time.time() )
+        return msgid
+
+    def _record( self, msgid, started ):
+        if started is not None:
+            self._servers.selector.record(
+                self.server, time.time() - started
+            )
+
+    def result( self, msgid=ldap.RES_ANY, all=1, timeout=None ):
+        entered = time.time()
+        args, started = self._pending.pop( msgid, ( None, None ) )
+        after = None
+        if args is not None and all:
+            after = self._servers.hedge_after( self.server )
+        if after is not None:
+            # timeout runs from now, not from when the search was sent
+            deadline = None
+            if timeout is not None and timeout >= 0:
+                deadline = entered + timeout
+            wait = max( 0, after - ( entered - started ) )
+            if deadline is None or wait < timeout:
+                try:
+                    if wait > 0:
+                        r = self._handle.result( msgid, all, wait )
+                        self._record( msgid, started )
+                        return r
+                except ldap.TIMEOUT:
+                    pass
+                return self._hedge( msgid, args, started, deadline )
+
+        r = self._handle.result( msgid, all, timeout )
+        self._record( msgid, started )
+        return r
+
+    def _hedge( self, msgid, args, started, deadline ):
+        """
+        races msgid against the same search sent to another server,
+        until one answers or time.time() passes `deadline` (if not None)
+        """
+        try:
+            # a hedge is only worth sending if it can go right away
+            with self._servers.connection(
+                exclude=( self.server, ), healthy_only=True, block=False
+            ) as other:
+                logging.debug(
+                    "hedging slow search on %s to %s",
+                    self.server, other.server
+                )
+                hedge_started = time.time()
+                other_msgid = other._handle.search( *args )
+                while True:
+                    try:
+                        r = self._handle.result( msgid, 1, 0 )
+                    except ldap.LDAPError:
+                        error = sys.exc_info()
+                        try:
+                            other._handle.abandon( other_msgid )
+                        except ldap.LDAPError:
+                            pass
+                        raise _PrimaryFailed( error )
+                    if r[0] is not None:
+                        other._handle.abandon( other_msgid )
+                        self._record( msgid, started )
+                        hedged.inc( 1, 'primary' )
+                        return r
+                    r = other._handle.result( other_msgid, 1, 0 )
+                    if r[0] is not None:
+                        self._handle.abandon( msgid )
+                        # the slow server is charged for the time so far
+                        self._record( msgid, started )
+                        other._record( other_msgid, hedge_started )
+                        hedged.inc( 1, 'hedge' )
+                        return r
+                    if deadline is not None and time.time() > deadline:
+                        self._handle.abandon( msgid )
+                        other._handle.abandon( other_msgid )
+                        hedged.inc( 1, 'timeout' )
+                        raise ldap.TIMEOUT( { 'desc': 'hedged search timed out' } )
+                    time.sleep( 0.002 )
+        except _PrimaryFailed, e:
+            raise e.error[0], e.error[1], e.error[2]
+        except ( ldap.SERVER_DOWN, ldap.CONNECT_ERROR, PoolTimeout ):
+            # nowhere to hedge to- wait on the original search
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    # a timeout of 0 would only poll
+                    raise ldap.TIMEOUT( { 'desc': 'hedged search timed out' } )
+            r = self._handle.result( msgid, 1, remaining )
+            self._record( msgid, started )
+            return r
+
+def paged_search(
+    connection, base, scope, filterstr, attrlist, page_size=500, timeout=60
+):
+    """
+    generator over the ( dn, attrs ) entries of a subtree search, read
+    with the Simple Paged Results control so AD's MaxPageSize does not
+    truncate the result.  Search references are skipped.
+    """
+    control = SimplePagedResultsControl( True, size=page_size, cookie='' )
+    while True:
+        msgid = connection.search_ext(
+            base, scope, filterstr, attrlist, serverctrls=[ control ]
+        )
+        rtype, entries, rmsgid, controls = connection.result3(
+            msgid, timeout=timeout
+        )
+        for dn, attrs in entries:
+            if dn is not None:
+                yield dn, attrs
+
+        cookie = None
+        for c in controls:
+            if c.controlType == SimplePagedResultsControl.controlType:
+                cookie = c.cookie
+        if not cookie:
+            break
+        control.cookie = cookie
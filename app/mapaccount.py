@@ -3,132 +3,806 @@
 
 from sets import Set
 import sys
+import copy
+import json
+import Queue
+import hashlib
+import time
+import threading
 import ldap
-import yaml
+
+from ldap.filter import escape_filter_chars
 
 from flask import render_template, flash, redirect
 from flask import jsonify
 from flask import request
+from flask import Response
+from flask import g
+from flask import url_for
 from app import app
 from forms import MapAccountForm
+from ldappool import LDAPServers
+from dncache import DNCache
+from picache import PICache
+from overrides import OverridesIndex
+from negative import NegativeCache, KnownUsers
+from singleflight import SingleFlight, FlightTimeout
+from deadline import DeadlineExceeded, Deadline
+import deadline
+from snapshot import SnapshotRefresher
+from sharedmap import SharedMap
+from jobs import JobQueue, JobStore, QueueFull, WorkerPool
+from members import MemberIndex
+from hierarchy import Hierarchy
+from store import MappingStore
+import sharedmap
+import metrics
+import offload
 
 import logging
-logging.basicConfig( level = logging.DEBUG )
+logging.basicConfig(
+    level = getattr( logging, app.config.get( 'LOG_LEVEL', 'INFO' ) )
+)
 
-def get_manager( connection, dn ):
+pool = LDAPServers(
+    app.config[ 'LDAP_SERVER' ],
+    app.config[ 'BINDDN' ],
+    app.config[ 'BINDPW' ],
+    eject = app.config.get( 'LDAP_EJECT_SECONDS', 30 ),
+    hedge_percentile = app.config.get( 'LDAP_HEDGE_PERCENTILE' ),
+    size = app.config.get( 'LDAP_POOL_SIZE', 4 ),
+    timeout = app.config.get( 'LDAP_POOL_TIMEOUT', 10 ),
+    max_age = app.config.get( 'LDAP_POOL_MAX_AGE', 600 ),
+    check_interval = app.config.get( 'LDAP_POOL_CHECK_INTERVAL', 30 ),
+    network_timeout = app.config.get( 'LDAP_NETWORK_TIMEOUT', 10 ),
+    initialize = offload.initialize
+)
+
+dn_cache = DNCache(
+    size = app.config.get( 'DN_CACHE_SIZE', 10000 ),
+    ttl = app.config.get( 'DN_CACHE_TTL', 300 )
+)
+
+pi_cache = PICache( ttl = app.config.get( 'PI_CACHE_TTL', 300 ) )
+
+overrides_index = OverridesIndex( app.config['OVERRIDES'] )
+
+member_index = MemberIndex( overrides_index )
+
+PAYROLL_TERMS = "(sAMAccountType=805306368)" + "(fhcrcpaygroup=Y)"
+PAYROLL_FILTER = "(&" + PAYROLL_TERMS + ")"
+
+negative_cache = NegativeCache(
+    size = app.config.get( 'NEGATIVE_CACHE_SIZE', 10000 ),
+    ttl = app.config.get( 'NEGATIVE_CACHE_TTL', 60 )
+)
+
+if app.config.get( 'FAST_REJECT', False ):
+    known_users = KnownUsers(
+        pool,
+        app.config[ 'LDAP_SEARCH_BASE' ],
+        PAYROLL_FILTER,
+        refresh = app.config.get( 'FAST_REJECT_REFRESH', 900 ),
+        page_size = app.config.get( 'LDAP_PAGE_SIZE', 500 )
+    )
+else:
+    known_users = None
+
+uid_flights = SingleFlight()
+dn_flights = SingleFlight()
+
+# uid -> ( uid, etag, generation ) for the last /rest/<uid> response
+etag_cache = DNCache(
+    size = app.config.get( 'DN_CACHE_SIZE', 10000 ),
+    ttl = app.config.get( 'REST_ETAG_TTL', 300 )
+)
+
+# with SHARED_MAP set, only the worker holding the map's lock builds
+# snapshots; it publishes each one and every worker maps the file
+if app.config.get( 'SHARED_MAP' ):
+    shared_map = SharedMap(
+        app.config[ 'SHARED_MAP' ],
+        max_age = app.config.get( 'SNAPSHOT_MAX_AGE', 7200 )
+    )
+else:
+    shared_map = None
+
+def publish_snapshot( snapshot ):
+    try:
+        sharedmap.publish( shared_map.path, snapshot, SHARED_ATTRS )
+    except ( IOError, OSError ), e:
+        logging.error( "unable to publish shared map: %s", e )
+
+if app.config.get( 'SNAPSHOT', False ) or shared_map is not None:
+    snapshots = SnapshotRefresher(
+        pool,
+        app.config[ 'LDAP_SEARCH_BASE' ],
+        app.config[ 'PI_TITLES' ],
+        app.config[ 'MAXTRIES' ],
+        interval = app.config.get( 'SNAPSHOT_REFRESH', 3600 ),
+        max_age = app.config.get( 'SNAPSHOT_MAX_AGE', 7200 ),
+        page_size = app.config.get( 'LDAP_PAGE_SIZE', 500 ),
+        on_build = publish_snapshot if shared_map is not None else None
+    )
+else:
+    snapshots = None
+
+def start_snapshots():
+    if shared_map is None or shared_map.elect():
+        snapshots.start()
+
+if snapshots is not None:
+    app.before_first_request( start_snapshots )
+
+# with MAPPING_STORE set, the table idmgr writes answers first
+if app.config.get( 'MAPPING_STORE' ):
+    mapping_store = MappingStore(
+        app.config[ 'MAPPING_STORE' ],
+        max_age = app.config.get( 'MAPPING_STORE_MAX_AGE', 86400 )
+    )
+else:
+    mapping_store = None
+
+def current_snapshot():
     """
-    returns the manager for the entity with the given dn.
+    returns the snapshot lookups should use- this process's own, else
+    the shared map- or None if neither is fresh
     """
+    snapshot = None
+    if snapshots is not None:
+        snapshot = snapshots.snapshot()
+    if snapshot is None and shared_map is not None:
+        snapshot = shared_map.snapshot()
+        if snapshot is None:
+            # the builder may have gone away- offer to take over
+            start_snapshots()
+    if snapshot is not None:
+        follow_snapshot( snapshot )
+    return snapshot
+
+def installed_snapshot():
+    """
+    returns the snapshot already in place, however old, without
+    refreshing, remapping or electing a builder
+    """
+    if snapshots is not None and snapshots.current is not None:
+        return snapshots.current
+    if shared_map is not None:
+        return shared_map.current
+    return None
+
+# the snapshot generation pi_cache's resolutions were last checked against
+pi_cache_snapshot = { 'generation': None }
+pi_cache_lock = threading.Lock()
+
+def follow_snapshot( snapshot ):
+    """
+    drops cached PI resolutions once a new snapshot is swapped in: the
+    directory it was read from may have moved people or PIs since
+    those chains were walked
+    """
+    if pi_cache_snapshot[ 'generation' ] == snapshot.generation:
+        return
+    with pi_cache_lock:
+        if pi_cache_snapshot[ 'generation' ] == snapshot.generation:
+            return
+        if pi_cache_snapshot[ 'generation' ] is not None:
+            pi_cache.invalidate()
+            logging.info(
+                "snapshot %s swapped in, PI cache dropped", snapshot.generation
+            )
+        pi_cache_snapshot[ 'generation' ] = snapshot.generation
+
+hierarchy = { 'generation': None, 'index': None }
+hierarchy_lock = threading.Lock()
+
+def current_hierarchy( snapshot ):
+    """
+    returns the Hierarchy for snapshot, built once per generation
+    """
+    with hierarchy_lock:
+        if hierarchy[ 'generation' ] != snapshot.generation:
+            start = time.time()
+            hierarchy[ 'index' ] = Hierarchy.from_entries(
+                snapshot.iterentries(), app.config['PI_TITLES']
+            )
+            hierarchy[ 'generation' ] = snapshot.generation
+            logging.info(
+                "hierarchy index: %s people in %.1f seconds",
+                len( hierarchy[ 'index' ] ), time.time() - start
+            )
+        return hierarchy[ 'index' ]
+
+def cache_generation():
+    """
+    returns a string that changes whenever cached PI resolutions are
+    invalidated, the overrides file is recompiled or a new directory
+    snapshot or mapping store is swapped in
+    """
+    overrides_index.refresh()
+    snapshot = current_snapshot()
+    store = mapping_store is not None and mapping_store.fresh()
+    return "%s.%s.%s.%s" % (
+        pi_cache.generation,
+        overrides_index.generation,
+        snapshot.generation if snapshot is not None else 0,
+        mapping_store.generation if store else 0
+    )
+
+route_latency = metrics.Histogram(
+    'mapaccount_request_seconds',
+    'time spent handling each route',
+    labels=( 'endpoint', )
+)
+route_requests = metrics.Counter(
+    'mapaccount_requests_total',
+    'requests handled, by route and status',
+    labels=( 'endpoint', 'status' )
+)
+lookup_round_trips = metrics.Histogram(
+    'mapaccount_lookup_ldap_round_trips',
+    'LDAP searches needed per uid lookup',
+    buckets=metrics.COUNT_BUCKETS
+)
+chain_hops = metrics.Histogram(
+    'mapaccount_manager_chain_hops',
+    'manager-chain hops walked before a PI was found',
+    buckets=metrics.COUNT_BUCKETS
+)
+overrides_latency = metrics.Histogram(
+    'mapaccount_process_overrides_seconds',
+    'time spent applying overrides for a uid'
+)
+
+snapshot_lookups = metrics.Counter(
+    'mapaccount_snapshot_lookups_total',
+    'uid lookups answered from (hit) or missing in (miss) the snapshot',
+    labels=( 'result', )
+)
+store_lookups = metrics.Counter(
+    'mapaccount_store_lookups_total',
+    'uid lookups answered from (hit) or missing in (miss) the mapping store',
+    labels=( 'result', )
+)
+metrics.Gauge(
+    'mapaccount_store_age_seconds',
+    'age of the mapping store in use',
+    lambda: mapping_store.age() if mapping_store else None
+)
+metrics.Gauge(
+    'mapaccount_snapshot_age_seconds',
+    'age of the directory snapshot in use',
+    lambda: installed_snapshot().age() if installed_snapshot() else None
+)
+
+def _cache_stat( stat ):
+    def read():
+        values = {
+            'dn': dn_cache.stats()[ stat ],
+            'pi': pi_cache.stats()[ stat ],
+            'negative': negative_cache.stats()[ stat ],
+            'etag': etag_cache.stats()[ stat ],
+        }
+        if stat == 'hits' and known_users is not None:
+            values[ 'known_users' ] = known_users.stats()[ 'rejects' ]
+        return values
+    return read
+
+metrics.Gauge(
+    'mapaccount_cache_hits_total', 'cache hits, by cache',
+    _cache_stat( 'hits' ), labels=( 'cache', ), type='counter'
+)
+metrics.Gauge(
+    'mapaccount_cache_misses_total', 'cache misses, by cache',
+    _cache_stat( 'misses' ), labels=( 'cache', ), type='counter'
+)
+metrics.Gauge(
+    'mapaccount_ldap_server_latency_seconds',
+    'moving average of LDAP result latency, by server',
+    lambda: dict(
+        ( s, v['ewma'] ) for s, v in pool.selector.stats().items()
+    ),
+    labels=( 'server', )
+)
+metrics.Gauge(
+    'mapaccount_ldap_server_ejected',
+    '1 while a server is ejected for failing',
+    lambda: dict(
+        ( s, int( v['ejected'] ) ) for s, v in pool.selector.stats().items()
+    ),
+    labels=( 'server', )
+)
+metrics.Gauge(
+    'mapaccount_cache_entries', 'entries held, by cache',
+    _cache_stat( 'size' ), labels=( 'cache', )
+)
+
+DN_ATTRS = [ 'title', 'manager', 'sn', 'givenName' ]
+# the shared map also carries usernames for the hierarchy index
+SHARED_ATTRS = DN_ATTRS + [ 'sAMAccountName' ]
+
+# marks a uid or chain that ran out of request time
+TIMED_OUT = object()
+
+def _result( connection, msgid ):
+    """
+    waits for msgid for at most LDAP_TIMEOUT seconds, or whatever is
+    left of the request's deadline if that is less.  A search given up
+    on is abandoned, so the server stops working on it and the
+    connection goes back to the pool with nothing outstanding.
+    """
+    try:
+        return connection.result(
+            msgid, 1, deadline.timeout( app.config.get( 'LDAP_TIMEOUT', 60 ) )
+        )
+    except ( ldap.TIMEOUT, DeadlineExceeded ):
+        error = sys.exc_info()
+        try:
+            connection.abandon( msgid )
+        except ldap.LDAPError, e:
+            logging.debug( "unable to abandon search %s: %s", msgid, e )
+        deadline.check()
+        raise error[0], error[1], error[2]
+
+def _wait( call ):
+    # waits on a shared lookup, within the request's deadline
+    try:
+        return call.wait(
+            deadline.timeout( app.config.get( 'SINGLEFLIGHT_TIMEOUT', 60 ) )
+        )
+    except FlightTimeout:
+        deadline.check()
+        raise
+
+def _read_attrs( connection, dn ):
     search = connection.search(
         base=dn,
         scope=ldap.SCOPE_BASE,
-        attrlist=[ 'manager' ]
+        attrlist=DN_ATTRS
     )
-    type, result = connection.result( search, 60 )
-    return result[0][1]['manager'][0]
+    type, result = _result( connection, search )
+    attrs = result[0][1]
+    dn_cache.put( dn, attrs )
+    return attrs
+
+def _mapped_attrs( dn ):
+    # DN attributes published in the shared map, if there is one
+    if shared_map is None:
+        return None
+    snapshot = shared_map.snapshot()
+    if snapshot is None:
+        return None
+    attrs = snapshot.attrs( dn )
+    if attrs is not None:
+        dn_cache.put( dn, attrs )
+    return attrs
+
+def get_attrs( connection, dn ):
+    """
+    returns the cached attributes (DN_ATTRS) for the entity with the
+    given dn, reading all of them from the directory on a cache miss.
+    Concurrent misses for the same dn share one read.
+    """
+    attrs = dn_cache.get( dn )
+    if attrs is None:
+        attrs = _mapped_attrs( dn )
+    if attrs is None:
+        call, leader = dn_flights.begin( dn.lower() )
+        if leader:
+            try:
+                attrs = _read_attrs( connection, dn )
+            except:
+                dn_flights.finish( dn.lower(), call, error=sys.exc_info() )
+                raise
+            dn_flights.finish( dn.lower(), call, attrs )
+        else:
+            attrs = _wait( call )
+        if attrs is None:
+            # shared with a fetch_attrs batch that did not return dn
+            attrs = _read_attrs( connection, dn )
+    return attrs
+
+def get_manager( connection, dn ):
+    """
+    returns the manager for the entity with the given dn.
+    """
+    return get_attrs( connection, dn )['manager'][0]
 
 def get_title( connection, dn ):
     """
     returns the title for the entity with the given dn.
     """
-    search = connection.search(
-        base=dn,
-        scope=ldap.SCOPE_BASE,
-        attrlist=[ 'title' ]
-    )
-    type, result = connection.result( search, 60 )
-    return result[0][1]['title'][0]
+    return get_attrs( connection, dn )['title'][0]
 
 def generate_account( connection, dn ):
-    search = connection.search(
-        base=dn,
-        scope=ldap.SCOPE_BASE,
-        attrlist=[ 'sn', 'givenName' ]
-    )
-    type, result = connection.result( search, 60 )
-    attrs = result[0][1]
+    attrs = get_attrs( connection, dn )
     return [ attrs['sn'][0].lower() + "_" + attrs['givenName'][0].lower()[0] ]
 
-def process_overrides( uid, accounts=[] ):
-    found = False
-    for o in yaml.load_all( file( app.config['OVERRIDES'], 'r' ) ):
+def fetch_attrs( connection, dns ):
+    """
+    reads DN_ATTRS into dn_cache for every dn not already cached, with
+    one (|(distinguishedName=...)...) search per LDAP_FILTER_BATCH dns.
+    DNs the search does not return are left for get_attrs to read.
+
+    DNs another request is already reading are waited for rather than
+    searched for again.
+    """
+    batch = app.config.get( 'LDAP_FILTER_BATCH', 100 )
+
+    wanted = {}
+    for dn in dns:
+        if ( dn.lower() not in wanted and not dn_cache.contains( dn ) and
+             _mapped_attrs( dn ) is None ):
+            wanted[ dn.lower() ] = dn
+
+    calls = {}
+    waiting = []
+    for key in wanted.keys():
+        call, leader = dn_flights.begin( key )
+        if leader:
+            calls[ key ] = call
+        else:
+            waiting.append( call )
+            del wanted[ key ]
+    wanted = wanted.values()
+
+    found = {}
+    try:
+        for i in range( 0, len( wanted ), batch ):
+            filter = "(|" + "".join(
+                "(distinguishedName=" + escape_filter_chars( dn ) + ")"
+                for dn in wanted[ i:i + batch ]
+            ) + ")"
+
+            p = connection.search(
+                app.config[ 'LDAP_SEARCH_BASE' ], ldap.SCOPE_SUBTREE,
+                filter, DN_ATTRS
+            )
+            type, entries = _result( connection, p )
+
+            for dn, attrs in entries:
+                if dn is not None:
+                    dn_cache.put( dn, attrs )
+                    found[ dn.lower() ] = attrs
+    except:
+        error = sys.exc_info()
+        for key, call in calls.iteritems():
+            dn_flights.finish( key, call, error=error )
+        raise
+
+    for key, call in calls.iteritems():
+        dn_flights.finish( key, call, found.get( key ) )
+
+    for call in waiting:
+        _wait( call )
+
+def resolve_pis( connection, dns ):
+    """
+    walks the manager chains starting at each of dns and returns a dict
+    mapping each dn to the account of the first PI found on its chain
+    (or of the top of the chain), or to None when no answer is reached
+    within MAXTRIES hops.  Chains still walking when the request's
+    deadline passes map to TIMED_OUT.
+
+    all chains advance together: each level reads the distinct DNs the
+    chains have reached in one batched fetch_attrs, so the number of
+    round trips follows the depth of the org chart, not the number of
+    chains.  Every DN walked is recorded in pi_cache, so later walks
+    through any of them finish at that node.
+    """
+    maxtries = app.config['MAXTRIES']
+
+    resolved = {}
+    chains = []
+    for dn in dns:
+        if dn not in resolved:
+            resolved[ dn ] = None
+            chains.append( { 'start': dn, 'dn': dn, 'path': [] } )
+
+    for locate in range( maxtries ):
+        pending = []
+        for chain in chains:
+            cached = pi_cache.get( chain['dn'], maxtries - locate )
+            if cached is None:
+                pending.append( chain )
+                continue
+            account, steps = cached
+            logging.debug(
+                "pi cache hit for %s after %s hops", chain['dn'], locate
+            )
+            pi_cache.compress( chain['path'], account, steps + 1 )
+            resolved[ chain['start'] ] = account
+            chain_hops.observe( locate )
+
+        if not pending:
+            break
+
         try:
-            if o[ 'username' ] == uid:
-                found = True
-                try:
-                    mode = o[ 'mode' ]
-                except KeyError:
-                    mode = 'r'
+            deadline.check()
+            fetch_attrs( connection, [ chain['dn'] for chain in pending ] )
+        except DeadlineExceeded:
+            for chain in pending:
+                resolved[ chain['start'] ] = TIMED_OUT
+            break
 
-                logging.debug(
-                    "Adding accounts %s with mode %s",
-                    o['alist'],
-                    mode
-                )
-                if mode == 'r':
-                    accounts = o[ 'alist' ]
-                elif mode == 'a':
-                    accounts = accounts + o[ 'alist' ]
+        chains = []
+        for chain in pending:
+            dn = chain['dn']
+            chain['path'].append( dn )
+            try:
+                manager_title = get_title( connection, dn )
+                if manager_title in app.config['PI_TITLES']:
+                    logging.debug( "found valid pi title %s for %s",
+                                  manager_title, dn
+                                 )
                 else:
-                    logging.error(
-                        'Unknown mode %s found in overrides file', mode
-                    )
-        except KeyError:
-            logging.debug( "Skipping non-username entry" )
-            continue
+                    try:
+                        chain['dn'] = get_manager( connection, dn )
+                        chains.append( chain )
+                        continue
+                    except KeyError:
+                        pass
 
-    if found:
-        return accounts
-    else:
+                account = generate_account( connection, dn )
+            except DeadlineExceeded:
+                resolved[ chain['start'] ] = TIMED_OUT
+                continue
+            pi_cache.compress( chain['path'], account, 1 )
+            resolved[ chain['start'] ] = account
+            chain_hops.observe( locate + 1 )
+
+    return resolved
+
+def process_overrides( uid, accounts=[] ):
+    with overrides_latency.time():
+        o = overrides_index.get( uid )
+    if o is None:
         return []
 
-def map_uid( uids ):
-    ADServer = "ldap://dc.fhcrc.org"
-    ADServer = app.config[ 'LDAP_SERVER' ]
-    ADSearchBase = "dc=fhcrc,dc=org"
+    logging.debug(
+        "Adding accounts %s (replace: %s)", o.alist, o.replace
+    )
+    return o.apply( accounts )
+
+def lookup_people( connection, uids ):
+    """
+    returns a dict mapping each lower-cased uid to the list of
+    ( dn, attrs ) person entries found for it, or to TIMED_OUT if the
+    request's deadline passed before it was searched for.
+
+    uids are looked up LDAP_FILTER_BATCH at a time with one
+    (|(sAMAccountName=a)(sAMAccountName=b)...) search per batch rather
+    than one search per uid.  Search references are dropped.
+    """
     ADSearchBase = app.config[ 'LDAP_SEARCH_BASE' ]
     ADSearchScope = ldap.SCOPE_SUBTREE
+    batch = app.config.get( 'LDAP_FILTER_BATCH', 100 )
 
-    l = ldap.initialize( ADServer )
-    l.set_option(ldap.OPT_REFERRALS, 0)
-    l.simple_bind_s( app.config['BINDDN'], app.config['BINDPW'] )
+    filter_base = "(&" + PAYROLL_TERMS
+    search_attrs = [ "sAMAccountName", "manager", ]
 
+    people = {}
+    wanted = []
+    for uid in uids:
+        # an empty value would make the whole OR filter invalid
+        if uid and uid.lower() not in people:
+            people[ uid.lower() ] = []
+            wanted.append( uid )
 
-    filter_base = "(&" + "(sAMAccountType=805306368)" + "(fhcrcpaygroup=Y)"
-    search_attrs = [ "sAMAccountName", "manager", ]
+    for i in range( 0, len( wanted ), batch ):
+        filter = filter_base + "(|" + "".join(
+            "(sAMAccountName=" + escape_filter_chars( uid ) + ")"
+            for uid in wanted[ i:i + batch ]
+        ) + "))"
 
+        try:
+            deadline.check()
+            p = connection.search(
+                ADSearchBase, ADSearchScope, filter, search_attrs
+            )
+            type, entries = _result( connection, p )
+        except DeadlineExceeded:
+            for uid in wanted[ i: ]:
+                people[ uid.lower() ] = TIMED_OUT
+            break
+
+        for dn, attrs in entries:
+            if dn is None:
+                continue
+            try:
+                name = attrs['sAMAccountName'][0].lower()
+            except KeyError:
+                continue
+            if name in people:
+                people[ name ].append( ( dn, attrs ) )
+
+    for uid in wanted:
+        if people[ uid.lower() ] == []:
+            negative_cache.add( uid )
+
+    return people
+
+def fast_reject( uid ):
+    """
+    returns True if uid is known not to be a payroll user, either from
+    a recent failed lookup or from the known_users scan
+    """
+    if not uid:
+        return False
+    if negative_cache.hit( uid ):
+        logging.debug( "negative cache hit for %s", uid )
+        return True
+    if known_users is not None and known_users.reject( uid ):
+        logging.debug( "%s is not a known payroll user", uid )
+        return True
+    return False
+
+def map_uid( uids ):
+    """
+    returns a dict mapping each uid (spelled as the directory has it
+    when found) to its list of accounts.  Uids that resolve to nothing
+    are left out; uids still unresolved when the request's deadline
+    passes map to None.
+    """
     results = {}
+    for partial in resolve_uids( uids ).values():
+        results.update( partial )
+    return results
+
+def resolve_uids( uids ):
+    """
+    returns a dict mapping each of uids to its own piece of the map_uid
+    result ( {} when it resolves to nothing ).
 
+    a uid that another request is already resolving is not looked up
+    again: this call waits for that resolution and gets a copy of its
+    result, or its exception.
+    """
+    calls = {}
+    led = []
     for uid in uids:
-        filter = filter_base + "(sAMAccountName=" + uid + "))"
+        if uid in calls:
+            continue
+        call, leader = uid_flights.begin( uid )
+        calls[ uid ] = ( call, leader )
+        if leader:
+            led.append( uid )
 
-        p = l.search( ADSearchBase, ADSearchScope, filter, search_attrs )
-        type, person = l.result( p, 60 )
+    try:
+        partials = _lookup( led ) if led else {}
+    except:
+        error = sys.exc_info()
+        for uid in led:
+            uid_flights.finish( uid, calls[ uid ][0], error=error )
+        raise
+    for uid in led:
+        uid_flights.finish( uid, calls[ uid ][0], partials[ uid ] )
+
+    results = {}
+    for uid, ( call, leader ) in calls.iteritems():
+        if leader:
+            results[ uid ] = partials[ uid ]
+            continue
+        logging.debug( "sharing in-flight lookup of %s", uid )
+        try:
+            results[ uid ] = copy.deepcopy( _wait( call ) )
+        except DeadlineExceeded:
+            results[ uid ] = { uid: None }
+    return results
 
-        if len(person) != 2:
-            if len(person) == 1:
+def _lookup( uids ):
+    results = {}
+
+    if mapping_store is not None and mapping_store.fresh():
+        for uid in uids:
+            hit = mapping_store.lookup( uid )
+            if hit is None:
+                continue
+            # the store holds what the directory gives; overrides are
+            # applied here, as map_uid applies them
+            username, alist, adef, is_pi = hit
+            if is_pi:
+                results[ uid ] = { username: alist }
+            else:
+                results[ uid ] = { username: with_overrides( uid, alist ) }
+        store_lookups.inc( len( results ), 'hit' )
+        store_lookups.inc( len( uids ) - len( results ), 'miss' )
+        uids = [ uid for uid in uids if uid not in results ]
+        if not uids:
+            return results
+
+    snapshot = current_snapshot()
+    if snapshot is not None:
+        answered = len( results )
+        for uid in uids:
+            hit = snapshot.lookup( uid )
+            if hit is None:
+                continue
+            name, account, is_pi = hit
+            if account is None:
+                results[ uid ] = {}
+            elif is_pi:
+                results[ uid ] = { name: list( account ) }
+            else:
+                results[ uid ] = { name: with_overrides( uid, list( account ) ) }
+        snapshot_lookups.inc( len( results ) - answered, 'hit' )
+        snapshot_lookups.inc( len( uids ) - len( results ) + answered, 'miss' )
+        uids = [ uid for uid in uids if uid not in results ]
+        if not uids:
+            return results
+
+    # rejected uids only get their overrides, so a request made up of
+    # nothing else never touches the directory
+    wanted = [ uid for uid in uids if not fast_reject( uid ) ]
+    if wanted:
+        with pool.connection() as l:
+            l = metrics.InstrumentedLDAP( l )
+            results.update( _map_uid( l, uids, wanted ) )
+        lookup_round_trips.observe( l.round_trips )
+    else:
+        results.update( _map_uid( None, uids, wanted ) )
+        lookup_round_trips.observe( 0 )
+    if logging.getLogger().isEnabledFor( logging.DEBUG ):
+        logging.debug( "dn cache stats: %s", dn_cache.stats() )
+    return results
+
+def _map_uid( l, uids, wanted ):
+    people = lookup_people( l, wanted )
+
+    # read every person found, then walk all of their manager chains
+    # together- see resolve_pis
+    found = [
+        person[0] for person in people.values()
+        if person is not TIMED_OUT and len( person ) == 1
+    ]
+    managers = []
+    try:
+        fetch_attrs( l, [ dn for dn, attrs in found ] )
+        for dn, attrs in found:
+            if get_title( l, dn ) not in app.config['PI_TITLES']:
+                try:
+                    managers.append( attrs['manager'][0] )
+                except KeyError:
+                    pass
+    except DeadlineExceeded:
+        # whatever was read so far is cached; the rest times out below
+        pass
+    pis = resolve_pis( l, managers )
+
+    results = {}
+
+    for uid in uids:
+        person = people.get( uid.lower(), [] )
+        results[ uid ] = {}
+
+        if person is TIMED_OUT:
+            results[ uid ] = { uid: None }
+            continue
+
+        if len(person) != 1:
+            if len(person) == 0:
                 logging.debug( "No data found for %s", uid )
-                results[ uid  ] = []
-            if len(person) > 2 :
+            if len(person) > 1 :
                 logging.debug( "Bizzare number of results (%s) found",
                                len(person)
                              )
-                results[ uid  ] = []
 
-            if process_overrides( uid ) is not None:
-                results[ uid ] = process_overrides( uid )
-            else:
+            results[ uid ] = { uid: process_overrides( uid ) }
+            if not results[ uid ][ uid ]:
                 logging.debug( "No override found for %s", uid )
             continue
 
         logging.debug( "found record: %s", person )
-        if get_title(l, person[0][0]) in app.config['PI_TITLES']:
-            results[ person[0][1]['sAMAccountName'][0] ] = (
-                generate_account( l, person[0][0] )
-            )
-            logging.debug(
-                "get_title() is true: person found in list of PI titles"
-            )
+        name = person[0][1]['sAMAccountName'][0]
+        try:
+            if get_title(l, person[0][0]) in app.config['PI_TITLES']:
+                results[ uid ] = { name: generate_account( l, person[0][0] ) }
+                logging.debug(
+                    "get_title() is true: person found in list of PI titles"
+                )
+                continue
+        except DeadlineExceeded:
+            results[ uid ] = { uid: None }
             continue
 
         try:
@@ -138,42 +812,356 @@ def map_uid( uids ):
             continue
         logging.debug( "manager set to %s", manager )
 
-        for locate in range(app.config['MAXTRIES']):
-            manager_title = get_title( l, manager )
-            if get_title( l, manager ) in app.config['PI_TITLES']:
-                results[ person[0][1]['sAMAccountName'][0] ] = ( 
-                    generate_account( l, manager )
-                )
-                logging.debug( "found valid pi title %s for %s", 
-                              manager_title, manager
-                             )
-                break
-            else:
-                try:
-                    manager = get_manager( l, manager )
-                except KeyError:
-                    results[ person[0][1]['sAMAccountName'][0] ] = (
-                        generate_account( l, manager )
-                    )
-                    break
-        else:
+        if manager not in pis or pis[ manager ] is TIMED_OUT:
+            results[ uid ] = { uid: None }
+            continue
+        if pis[ manager ] is None:
             continue
+        # chains can share a start- each person gets their own copy
+        results[ uid ] = { name: with_overrides( uid, list( pis[ manager ] ) ) }
+
+    return results
 
-        logging.debug( "results before overrides: %s", results )
-        logging.debug( "processing overrides for %s", uid )
-        overrides = process_overrides( uid )
-        logging.debug( "found overrides: %s", overrides )
+def with_overrides( uid, accounts ):
+    """
+    extends accounts (in place) with uid's override accounts it lacks
+    """
+    logging.debug( "accounts before overrides: %s", accounts )
+    logging.debug( "processing overrides for %s", uid )
+    overrides = process_overrides( uid )
+    logging.debug( "found overrides: %s", overrides )
 
-        tmp = results[ person[0][1]['sAMAccountName'][0] ]
-        tmp.extend( override for override in overrides if override not in tmp )
+    accounts.extend(
+        override for override in overrides if override not in accounts
+    )
+    return accounts
 
-        results[ person[0][1]['sAMAccountName'][0] ] = ( tmp )
+@app.before_request
+def start_timer():
+    g.start = time.time()
 
-    return results
+@app.after_request
+def record_request( response ):
+    endpoint = request.endpoint or 'unknown'
+    try:
+        route_latency.observe( time.time() - g.start, endpoint )
+    except AttributeError:
+        pass
+    route_requests.inc( 1, endpoint, response.status_code )
+    return response
+
+@app.route( '/metrics', methods = [ 'GET' ] )
+def mapaccount_metrics():
+    return Response(
+        metrics.render(), mimetype='text/plain; version=0.0.4'
+    )
+
+def request_timeout():
+    """
+    the seconds this request may take: REQUEST_TIMEOUT, or what the
+    caller asked for with ?timeout= or X-Request-Timeout, capped at
+    REQUEST_TIMEOUT_MAX
+    """
+    seconds = app.config.get( 'REQUEST_TIMEOUT', 30 )
+    asked = request.args.get(
+        'timeout', request.headers.get( 'X-Request-Timeout' )
+    )
+    if asked is not None:
+        try:
+            seconds = float( asked )
+        except ValueError:
+            pass
+    return max( 0, min( seconds, app.config.get( 'REQUEST_TIMEOUT_MAX', 120 ) ) )
+
+def request_deadline():
+    """
+    the Deadline for this request, request_timeout() seconds from now
+    """
+    return Deadline( request_timeout() )
+
+def timed_out( results ):
+    """
+    True if any uid in map_uid's results ran out of request time
+    """
+    return any( accounts is None for accounts in results.values() )
 
 @app.route( '/rest/<uid>', methods = [ 'GET' ] )
 def mapaccount_rest(uid):
-    return jsonify( map_uid([ uid ]) )
+    max_age = app.config.get( 'REST_MAX_AGE', 60 )
+    generation = cache_generation()
+
+    # a matching ETag issued under the current generation can be
+    # answered without walking the directory again
+    stored = etag_cache.get( uid )
+    if ( stored is not None and stored[0] == uid and
+         stored[2] == generation and
+         request.if_none_match.contains( stored[1] ) ):
+        response = Response( status=304 )
+        response.set_etag( stored[1] )
+    else:
+        with deadline.use( request_deadline() ):
+            results = map_uid([ uid ])
+        if timed_out( results ):
+            # partial answer- neither cached nor conditional
+            response = jsonify( results )
+            response.status_code = 504
+            response.cache_control.no_store = True
+            return response
+        etag = hashlib.sha1(
+            json.dumps( results, sort_keys=True ) + generation
+        ).hexdigest()
+        etag_cache.put( uid, ( uid, etag, generation ) )
+        response = jsonify( results )
+        response.set_etag( etag )
+        response.make_conditional( request )
+
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    snapshot = current_snapshot()
+    if snapshot is not None:
+        response.headers[ 'X-Snapshot-Age' ] = "%d" % snapshot.age()
+    return response
+
+def page_args():
+    """
+    returns the ( offset, limit ) asked for, limit defaulting to
+    MEMBERS_PAGE_SIZE and capped at MEMBERS_PAGE_MAX
+    """
+    offset = max( 0, int( request.args.get( 'offset', 0 ) ) )
+    limit = int(
+        request.args.get( 'limit', app.config.get( 'MEMBERS_PAGE_SIZE', 100 ) )
+    )
+    return offset, max(
+        1, min( limit, app.config.get( 'MEMBERS_PAGE_MAX', 1000 ) )
+    )
+
+@app.route( '/rest/members/<account>', methods = [ 'GET' ] )
+def mapaccount_members( account ):
+    """
+    the usernames mapping to account, `limit` (default MEMBERS_PAGE_SIZE)
+    at a time from `offset`, with a link to the next page
+    """
+    snapshot = current_snapshot()
+    if snapshot is None:
+        return jsonify( error='no directory snapshot available' ), 503
+
+    try:
+        offset, limit = page_args()
+    except ValueError:
+        return jsonify( error='offset and limit must be integers' ), 400
+
+    total, members = member_index.members( snapshot, account, offset, limit )
+    if offset + limit < total:
+        next = url_for(
+            'mapaccount_members', account=account,
+            offset=offset + limit, limit=limit
+        )
+    else:
+        next = None
+    response = jsonify(
+        account=account, total=total, offset=offset, limit=limit,
+        members=members, next=next
+    )
+    response.headers[ 'X-Snapshot-Age' ] = "%d" % snapshot.age()
+    return response
+
+@app.route( '/rest/reports/<pi>', methods = [ 'GET' ] )
+def mapaccount_reports( pi ):
+    """
+    the usernames of pi's reports- everyone below pi down to and
+    including the next PI- or with ?all=1 everyone below pi, paged
+    like /rest/members/<account>
+    """
+    snapshot = current_snapshot()
+    if snapshot is None:
+        return jsonify( error='no directory snapshot available' ), 503
+    index = current_hierarchy( snapshot )
+
+    dn = index.dn( pi )
+    if dn is None or dn not in index.pis:
+        return jsonify( error='no such PI' ), 404
+    try:
+        offset, limit = page_args()
+    except ValueError:
+        return jsonify( error='offset and limit must be integers' ), 400
+    everyone = request.args.get( 'all', '' ).lower() in ( '1', 'true', 'yes' )
+
+    if everyone:
+        dns = index.subtree( dn )
+    else:
+        dns = index.reports( dn )
+    if offset + limit < len( dns ):
+        next = url_for(
+            'mapaccount_reports', pi=pi, offset=offset + limit, limit=limit,
+            all=int( everyone )
+        )
+    else:
+        next = None
+    response = jsonify(
+        pi=index.username( dn ), total=len( dns ), offset=offset,
+        limit=limit, next=next,
+        reports=[
+            index.username( report ) for report in dns[ offset:offset + limit ]
+        ]
+    )
+    response.headers[ 'X-Snapshot-Age' ] = "%d" % snapshot.age()
+    return response
+
+# chunks from every batch request share these threads
+batch_workers = WorkerPool( app.config.get( 'BATCH_WORKERS', 8 ), 'batch' )
+
+metrics.Gauge(
+    'mapaccount_batch_chunks_queued', 'batch chunks waiting for a worker',
+    batch_workers.depth
+)
+
+def stream_batch( uids, concurrency, chunk, seconds=None ):
+    """
+    generator of NDJSON lines, one per uid, in the order the uids
+    resolve.  The uids go through resolve_uids `chunk` at a time on the
+    shared batch_workers, with at most `concurrency` chunks of this
+    batch waiting or running at once.  Each chunk gets its own Deadline
+    of `seconds` from when a worker takes it up.
+    """
+    chunks = iter( [
+        uids[ i:i + chunk ] for i in range( 0, len( uids ), chunk )
+    ] )
+    lines = Queue.Queue()
+    stop = threading.Event()
+
+    def run( todo ):
+        try:
+            if stop.is_set():
+                return
+            budget = Deadline( seconds ) if seconds is not None else None
+            try:
+                with deadline.use( budget ):
+                    partials = resolve_uids( todo )
+            except Exception, e:
+                logging.exception( "batch lookup failed" )
+                for uid in todo:
+                    lines.put( { 'uid': uid, 'error': str( e ) } )
+                return
+            for uid in todo:
+                lines.put( { 'uid': uid, 'result': partials[ uid ] } )
+        finally:
+            lines.put( None )
+
+    def submit():
+        todo = next( chunks, None )
+        if todo is None:
+            return 0
+        batch_workers.submit( run, todo )
+        return 1
+
+    running = 0
+    for n in range( concurrency ):
+        running += submit()
+
+    try:
+        while running:
+            line = lines.get()
+            if line is None:
+                running += submit() - 1
+                continue
+            yield json.dumps( line ) + "\n"
+    finally:
+        # client went away- leave the remaining chunks alone
+        stop.set()
+
+@app.route( '/rest/batch', methods = [ 'POST' ] )
+def mapaccount_batch():
+    """
+    takes a JSON list of uids (or {"uids": [...]}) and streams back one
+    {"uid": ..., "result": ...} line per uid, where result is what
+    /rest/<uid> would return for it.
+    """
+    body = request.get_json( force=True, silent=True )
+    if isinstance( body, dict ):
+        body = body.get( 'uids' )
+    if ( not isinstance( body, list ) or
+         not all( isinstance( uid, basestring ) for uid in body ) ):
+        return jsonify( error='expected a JSON list of uids' ), 400
+
+    uids = []
+    seen = set()
+    for uid in body:
+        uid = uid.strip()
+        if uid and uid not in seen:
+            seen.add( uid )
+            uids.append( uid )
+
+    limit = app.config.get( 'BATCH_MAX_UIDS', 5000 )
+    if len( uids ) > limit:
+        return jsonify(
+            error='batch of %s uids exceeds the limit of %s' % (
+                len( uids ), limit
+            )
+        ), 413
+
+    return Response(
+        stream_batch(
+            uids,
+            app.config.get( 'BATCH_CONCURRENCY', 4 ),
+            app.config.get( 'BATCH_CHUNK', 25 ),
+            request_timeout()
+        ),
+        mimetype='application/x-ndjson'
+    )
+
+def job_chunk( uids ):
+    """
+    resolves one chunk of a job, with a request's budget per chunk
+    """
+    with deadline.use( Deadline( app.config.get( 'REQUEST_TIMEOUT', 30 ) ) ):
+        return map_uid( uids )
+
+# with JOB_STORE set, job state is kept where every worker process can
+# find it; without it a job can only be polled on the process running it
+jobs = JobQueue(
+    job_chunk,
+    workers = app.config.get( 'JOB_WORKERS', 2 ),
+    size = app.config.get( 'JOB_QUEUE_SIZE', 20 ),
+    chunk = app.config.get( 'BATCH_CHUNK', 25 ),
+    ttl = app.config.get( 'JOB_TTL', 3600 ),
+    store = JobStore( app.config['JOB_STORE'] )
+        if app.config.get( 'JOB_STORE' ) else None
+)
+
+metrics.Gauge(
+    'mapaccount_jobs_queued', 'jobs waiting for a worker', jobs.depth
+)
+metrics.Gauge(
+    'mapaccount_jobs', 'jobs held, by state',
+    jobs.stats, labels=( 'state', )
+)
+
+def job_response( job, status_code=200 ):
+    response = jsonify( job.status() )
+    response.status_code = status_code
+    response.headers[ 'Location' ] = url_for( 'mapaccount_job', id=job.id )
+    return response
+
+@app.route( '/jobs/<id>', methods = [ 'GET' ] )
+def mapaccount_job( id ):
+    job = jobs.get( id )
+    if job is None:
+        return jsonify( error='no such job' ), 404
+    return job_response( job )
+
+@app.route( '/jobs/<id>/result', methods = [ 'GET' ] )
+def mapaccount_job_result( id ):
+    """
+    the job's results once it is done; until then its status, with 202
+    """
+    job = jobs.get( id )
+    if job is None:
+        return jsonify( error='no such job' ), 404
+    if job.state == 'failed':
+        return job_response( job, 500 )
+    if job.state != 'done':
+        return job_response( job, 202 )
+    return jsonify( job.results )
 
 @app.route( '/form', methods = [ 'GET', 'POST' ] )
 def mapaccount_post():
@@ -185,7 +1173,26 @@ def mapaccount_post():
         print "submitting"
         uids = request.form['uids'].replace( " ", "" )
         uids = uids.split(',')
-        return jsonify( map_uid( uids ) )
+
+        # large submissions become a job the client polls for
+        if len( uids ) > app.config.get( 'JOB_THRESHOLD', 200 ):
+            try:
+                job = jobs.submit( uids )
+            except QueueFull, e:
+                response = jsonify( error=str( e ) )
+                response.status_code = 429
+                response.headers[ 'Retry-After' ] = "%d" % (
+                    app.config.get( 'JOB_RETRY_AFTER', 30 )
+                )
+                return response
+            return job_response( job, 202 )
+
+        with deadline.use( request_deadline() ):
+            results = map_uid( uids )
+        response = jsonify( results )
+        if timed_out( results ):
+            response.status_code = 504
+        return response
 
     return render_template('uids.html', title='Enter UIDs', form = form )
 
@@ -0,0 +1,85 @@
+# -*- coding: UTF-8 -*-
+
+import time
+import logging
+import threading
+
+class MemberIndex( object ):
+    """
+    account -> sorted list of the usernames that map to it: the forward
+    mapping of a snapshot turned around, with overrides applied the way
+    map_uid applies them.
+
+    the index is rebuilt whenever the snapshot or the overrides file it
+    was built from changes generation.  People the snapshot leaves out
+    (their chain left the snapshot) are missing unless overridden.
+    """
+    def __init__( self, overrides ):
+        self.overrides = overrides
+        self.built = None
+        self._key = None
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def _build( self, snapshot ):
+        overridden = dict( self.overrides.items() )
+        members = {}
+
+        def add( account, username ):
+            members.setdefault( account, set() ).add( username )
+
+        seen = set()
+        for key, ( name, accounts, is_pi ) in snapshot.iterpeople():
+            seen.add( key )
+            if accounts is None:
+                continue
+            accounts = list( accounts )
+            # PIs get their own account only- see _map_uid
+            o = None if is_pi else overridden.get( name )
+            if o is not None:
+                accounts.extend( a for a in o.apply() if a not in accounts )
+            for account in accounts:
+                add( account, name )
+
+        # usernames the directory does not resolve get their overrides
+        for username, o in overridden.iteritems():
+            if username.lower() in seen:
+                continue
+            for account in o.apply():
+                add( account, username )
+
+        return dict(
+            ( account, sorted( names ) )
+            for account, names in members.iteritems()
+        )
+
+    def refresh( self, snapshot ):
+        """
+        rebuilds the index if snapshot or the overrides have moved on
+        """
+        self.overrides.refresh()
+        key = ( snapshot.generation, self.overrides.generation )
+        if key == self._key:
+            return
+        with self._lock:
+            if key == self._key:
+                return
+            start = time.time()
+            self._index = self._build( snapshot )
+            self._key = key
+            self.built = time.time()
+            logging.info(
+                "member index: %s accounts in %.1f seconds",
+                len( self._index ), self.built - start
+            )
+
+    def members( self, snapshot, account, offset=0, limit=None ):
+        """
+        returns ( total, usernames ) for account, usernames being the
+        slice [ offset:offset + limit ] of its sorted members
+        """
+        self.refresh( snapshot )
+        names = self._index.get( account, [] )
+        if limit is None:
+            return len( names ), names[ offset: ]
+        return len( names ), names[ offset:offset + limit ]
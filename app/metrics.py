@@ -0,0 +1,188 @@
+# -*- coding: UTF-8 -*-
+
+import time
+import threading
+
+# latency buckets, in seconds
+TIME_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+# buckets for small counts (round trips, hops)
+COUNT_BUCKETS = ( 0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 15, 20, 50, 100 )
+
+def _labels( names, values ):
+    if not names:
+        return ""
+    return "{" + ",".join(
+        '%s="%s"' % ( n, str( v ).replace( '\\', '\\\\' ).replace( '"', '\\"' ) )
+        for n, v in zip( names, values )
+    ) + "}"
+
+class Counter( object ):
+    def __init__( self, name, help, labels=() ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append( self )
+
+    def inc( self, amount=1, *labels ):
+        with self._lock:
+            self._values[ labels ] = self._values.get( labels, 0 ) + amount
+
+    def render( self ):
+        lines = [
+            "# HELP %s %s" % ( self.name, self.help ),
+            "# TYPE %s counter" % self.name,
+        ]
+        with self._lock:
+            for labels, value in sorted( self._values.items() ):
+                lines.append( "%s%s %s" % (
+                    self.name, _labels( self.labels, labels ), value
+                ) )
+        return lines
+
+class Histogram( object ):
+    def __init__( self, name, help, labels=(), buckets=TIME_BUCKETS ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append( self )
+
+    def observe( self, value, *labels ):
+        with self._lock:
+            try:
+                counts, total = self._values[ labels ]
+            except KeyError:
+                counts, total = [ 0 ] * len( self.buckets ), [ 0, 0 ]
+                self._values[ labels ] = ( counts, total )
+            for i, bound in enumerate( self.buckets ):
+                if value <= bound:
+                    counts[i] += 1
+            total[0] += 1
+            total[1] += value
+
+    def time( self, *labels ):
+        return _Timer( self, labels )
+
+    def render( self ):
+        lines = [
+            "# HELP %s %s" % ( self.name, self.help ),
+            "# TYPE %s histogram" % self.name,
+        ]
+        names = self.labels + ( 'le', )
+        with self._lock:
+            for labels, ( counts, total ) in sorted( self._values.items() ):
+                for bound, count in zip( self.buckets, counts ):
+                    lines.append( "%s_bucket%s %s" % (
+                        self.name, _labels( names, labels + ( bound, ) ), count
+                    ) )
+                lines.append( "%s_bucket%s %s" % (
+                    self.name, _labels( names, labels + ( '+Inf', ) ), total[0]
+                ) )
+                lines.append( "%s_count%s %s" % (
+                    self.name, _labels( self.labels, labels ), total[0]
+                ) )
+                lines.append( "%s_sum%s %s" % (
+                    self.name, _labels( self.labels, labels ), total[1]
+                ) )
+        return lines
+
+class Gauge( object ):
+    """
+    value read from `fn` when the metrics are scraped; fn returns a
+    number, or a dict of label value -> number for a single label.
+    """
+    def __init__( self, name, help, fn, labels=(), type='gauge' ):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labels = labels
+        self.type = type
+        REGISTRY.append( self )
+
+    def render( self ):
+        lines = [
+            "# HELP %s %s" % ( self.name, self.help ),
+            "# TYPE %s %s" % ( self.name, self.type ),
+        ]
+        value = self.fn()
+        if isinstance( value, dict ):
+            for label, v in sorted( value.items() ):
+                if v is not None:
+                    lines.append( "%s%s %s" % (
+                        self.name, _labels( self.labels, ( label, ) ), v
+                    ) )
+        elif value is not None:
+            lines.append( "%s %s" % ( self.name, value ) )
+        return lines
+
+class _Timer( object ):
+    def __init__( self, histogram, labels ):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__( self ):
+        self.start = time.time()
+        return self
+
+    def __exit__( self, *exc ):
+        self.histogram.observe( time.time() - self.start, *self.labels )
+        return False
+
+REGISTRY = []
+
+def render():
+    """
+    returns every registered metric in the Prometheus text format
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend( metric.render() )
+    return "\n".join( lines ) + "\n"
+
+ldap_calls = Counter(
+    'mapaccount_ldap_requests_total',
+    'LDAP operations sent, by operation',
+    labels=( 'operation', )
+)
+ldap_latency = Histogram(
+    'mapaccount_ldap_round_trip_seconds',
+    'time spent waiting on LDAP results, by operation',
+    labels=( 'operation', )
+)
+
+class InstrumentedLDAP( object ):
+    """
+    proxy for an ldap handle that counts searches and times the result
+    calls that wait on them.  `round_trips` counts the searches made
+    through this proxy.
+    """
+    def __init__( self, handle ):
+        self._handle = handle
+        self.round_trips = 0
+
+    def __getattr__( self, name ):
+        return getattr( self._handle, name )
+
+    def search( self, *args, **kwargs ):
+        self.round_trips += 1
+        ldap_calls.inc( 1, 'search' )
+        return self._handle.search( *args, **kwargs )
+
+    def search_ext( self, *args, **kwargs ):
+        self.round_trips += 1
+        ldap_calls.inc( 1, 'search' )
+        return self._handle.search_ext( *args, **kwargs )
+
+    def result( self, *args, **kwargs ):
+        with ldap_latency.time( 'result' ):
+            return self._handle.result( *args, **kwargs )
+
+    def result3( self, *args, **kwargs ):
+        with ldap_latency.time( 'result' ):
+            return self._handle.result3( *args, **kwargs )
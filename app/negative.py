@@ -0,0 +1,101 @@
+# -*- coding: UTF-8 -*-
+
+import time
+import logging
+import threading
+
+import ldap
+
+from ldappool import paged_search
+from dncache import DNCache
+
+class NegativeCache( DNCache ):
+    """
+    remembers uids the directory had no payroll record for.  Uses the
+    DNCache machinery with its own (usually shorter) TTL; `hits` counts
+    the LDAP searches it saved.
+    """
+    def add( self, uid ):
+        self.put( uid, True )
+
+    def hit( self, uid ):
+        return self.get( uid ) is not None
+
+class KnownUsers( object ):
+    """
+    exact set of payroll usernames from a periodic directory scan.
+
+    until the first scan completes the set is not `ready` and rejects
+    nothing.  A scan runs in a background thread once the set is older
+    than `refresh` seconds, so requests keep using the previous set
+    meanwhile.  Users added since the last scan are rejected until the
+    next one- keep `refresh` short if that matters.
+    """
+    def __init__( self, pool, base, filterstr, refresh=900, page_size=500 ):
+        self.pool = pool
+        self.base = base
+        self.filterstr = filterstr
+        self.refresh = refresh
+        self.page_size = page_size
+        self.rejects = 0
+        self.loaded = None
+        self._names = None
+        self._lock = threading.Lock()
+        self._scanning = False
+
+    def ready( self ):
+        return self._names is not None
+
+    def _scan( self ):
+        try:
+            names = set()
+            with self.pool.connection() as l:
+                for dn, attrs in paged_search(
+                    l, self.base, ldap.SCOPE_SUBTREE, self.filterstr,
+                    [ 'sAMAccountName' ], self.page_size
+                ):
+                    try:
+                        names.add( attrs['sAMAccountName'][0].lower() )
+                    except KeyError:
+                        continue
+            self._names = frozenset( names )
+            self.loaded = time.time()
+            logging.info( "loaded %s known usernames", len( names ) )
+        except Exception, e:
+            logging.error( "scan for known usernames failed: %s", e )
+        finally:
+            with self._lock:
+                self._scanning = False
+
+    def check( self ):
+        """
+        starts a background scan if the set is missing or stale
+        """
+        if self.loaded is not None and time.time() - self.loaded < self.refresh:
+            return
+        with self._lock:
+            if self._scanning:
+                return
+            self._scanning = True
+        t = threading.Thread( target=self._scan, name='known-users-scan' )
+        t.daemon = True
+        t.start()
+
+    def reject( self, uid ):
+        """
+        returns True if uid is certainly not a payroll user
+        """
+        self.check()
+        names = self._names
+        if names is None or uid.lower() in names:
+            return False
+        with self._lock:
+            self.rejects += 1
+        return True
+
+    def stats( self ):
+        return {
+            'size': len( self._names or () ),
+            'age': ( time.time() - self.loaded ) if self.loaded else None,
+            'rejects': self.rejects,
+        }
@@ -0,0 +1,52 @@
+# -*- coding: UTF-8 -*-
+
+import ldap
+
+# set by configure() when serving from gevent
+_pool = None
+
+def configure( size ):
+    """
+    runs the blocking calls made through call() on a gevent thread pool
+    of `size` threads, so they no longer hold up the event loop
+    """
+    global _pool
+    from gevent.threadpool import ThreadPool
+    _pool = ThreadPool( size )
+
+def call( fn, *args, **kwargs ):
+    """
+    calls fn on the thread pool if there is one, else directly
+    """
+    if _pool is None:
+        return fn( *args, **kwargs )
+    return _pool.apply( fn, args, kwargs )
+
+def _blocks( name ):
+    # result waits and the synchronous operations wait on the network;
+    # search, abandon and set_option return at once
+    return name.startswith( 'result' ) or name.endswith( '_s' )
+
+class OffloadedLDAP( object ):
+    """
+    proxy for an ldap handle that makes its blocking calls through call()
+    """
+    def __init__( self, handle ):
+        self._handle = handle
+
+    def __getattr__( self, name ):
+        attr = getattr( self._handle, name )
+        if not _blocks( name ) or not callable( attr ):
+            return attr
+        def offloaded( *args, **kwargs ):
+            return call( attr, *args, **kwargs )
+        return offloaded
+
+def initialize( uri ):
+    """
+    drop-in for ldap.initialize: handles made once configure() has run
+    are OffloadedLDAP proxies
+    """
+    if _pool is None:
+        return ldap.initialize( uri )
+    return OffloadedLDAP( ldap.initialize( uri ) )
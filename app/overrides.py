@@ -0,0 +1,139 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import hashlib
+import logging
+import threading
+
+import yaml
+
+from metrics import Histogram
+
+parse_time = Histogram(
+    'mapaccount_overrides_parse_seconds',
+    'time spent compiling the overrides file'
+)
+
+class Override( object ):
+    """
+    the net effect of every override entry for one username.
+
+    entries are folded in file order: mode 'r' replaces whatever came
+    before with its alist, mode 'a' appends its alist.  If any entry
+    replaced, the caller's accounts are discarded.
+    """
+    def __init__( self, username ):
+        self.username = username
+        self.replace = False
+        self.alist = []
+
+    def add( self, mode, alist ):
+        if mode == 'r':
+            self.replace = True
+            self.alist = list( alist )
+        elif mode == 'a':
+            self.alist = self.alist + alist
+        else:
+            logging.error( 'Unknown mode %s found in overrides file', mode )
+
+    def apply( self, accounts=[] ):
+        if self.replace:
+            return list( self.alist )
+        return accounts + self.alist
+
+class OverridesIndex( object ):
+    """
+    the overrides file compiled into an Override per username.
+
+    the file is only re-read when its mtime or size changes and only
+    recompiled when its content hash differs.  A new index replaces the
+    old one in a single assignment, and a file that fails to parse
+    leaves the last good index in place.
+    """
+    def __init__( self, path ):
+        self.path = path
+        self.generation = 0
+        self._index = {}
+        self._stat = None
+        self._digest = None
+        self._lock = threading.Lock()
+
+    def _compile( self, data ):
+        index = {}
+        for o in yaml.load_all( data ):
+            try:
+                username = o[ 'username' ]
+                alist = o[ 'alist' ]
+            except ( KeyError, TypeError ):
+                logging.debug( "Skipping non-username entry" )
+                continue
+            if type( alist ) is not list:
+                # yaml only encodes multiple entries as a list type
+                alist = [ alist ]
+            try:
+                mode = o[ 'mode' ]
+            except KeyError:
+                mode = 'r'
+            if username not in index:
+                index[ username ] = Override( username )
+            index[ username ].add( mode, alist )
+        return index
+
+    def refresh( self ):
+        """
+        recompiles the index if the overrides file has changed
+        """
+        try:
+            st = os.stat( self.path )
+        except OSError, e:
+            logging.error( "unable to stat overrides file: %s", e )
+            return
+        stat = ( st.st_mtime, st.st_size )
+        if stat == self._stat:
+            return
+
+        with self._lock:
+            if stat == self._stat:
+                return
+            self._stat = stat
+            try:
+                f = open( self.path, 'r' )
+                data = f.read()
+                f.close()
+            except IOError, e:
+                logging.error( "unable to read overrides file: %s", e )
+                return
+
+            digest = hashlib.sha1( data ).hexdigest()
+            if digest == self._digest:
+                return
+            try:
+                with parse_time.time():
+                    index = self._compile( data )
+            except yaml.YAMLError, e:
+                logging.error(
+                    "failed parsing overrides file %s, keeping last " +
+                    "good version: %s", self.path, e
+                )
+                return
+
+            self._index = index
+            self._digest = digest
+            self.generation += 1
+            logging.info(
+                "loaded %s user overrides from %s", len( index ), self.path
+            )
+
+    def get( self, username ):
+        """
+        returns the Override for username, or None
+        """
+        self.refresh()
+        return self._index.get( username )
+
+    def items( self ):
+        """
+        returns ( username, Override ) for every username overridden
+        """
+        self.refresh()
+        return self._index.items()
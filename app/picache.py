@@ -0,0 +1,72 @@
+# -*- coding: UTF-8 -*-
+
+import time
+import threading
+
+class PICache( object ):
+    """
+    memo of "DN -> resolved PI account" for nodes on walked manager chains.
+
+    every entry records how many MAXTRIES iterations the walk needed
+    from that node, so a lookup only succeeds when the caller still has
+    at least that many hops of budget left- chains that would have run
+    out of tries keep doing so.  Entries expire after `ttl` seconds, and
+    invalidate() drops everything at once by bumping the generation.
+    """
+    def __init__( self, ttl=300 ):
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get( self, dn, budget ):
+        """
+        returns ( account, steps ) for dn if it resolves within `budget`
+        hops, otherwise None.
+        """
+        key = dn.lower()
+        with self._lock:
+            try:
+                generation, stored, account, steps = self._entries[ key ]
+            except KeyError:
+                self.misses += 1
+                return None
+            if ( generation != self.generation or
+                 time.time() - stored > self.ttl ):
+                del self._entries[ key ]
+                self.misses += 1
+                return None
+            if steps > budget:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list( account ), steps
+
+    def compress( self, path, account, steps ):
+        """
+        records account for every DN on path; path[-1] resolved in
+        `steps` hops and each earlier node needs one hop more.
+        """
+        now = time.time()
+        account = tuple( account )
+        with self._lock:
+            for i, dn in enumerate( reversed( path ) ):
+                self._entries[ dn.lower() ] = (
+                    self.generation, now, account, steps + i
+                )
+
+    def invalidate( self ):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats( self ):
+        with self._lock:
+            return {
+                'size': len( self._entries ),
+                'generation': self.generation,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
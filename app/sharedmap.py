@@ -0,0 +1,253 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import json
+import mmap
+import time
+import fcntl
+import struct
+import logging
+import tempfile
+import threading
+
+# file layout:
+#   header   magic, version, generation, build time, entry count
+#   index    one ( key offset, key length, value offset, value length )
+#            per entry, sorted by key
+#   data     keys and JSON-encoded values
+MAGIC = 'MAPACCT\0'
+VERSION = 1
+HEADER = struct.Struct( '<8sIQdI' )
+ENTRY = struct.Struct( '<IIII' )
+
+UID_PREFIX = 'u:'
+DN_PREFIX = 'd:'
+
+def _key( prefix, name ):
+    if isinstance( name, unicode ):
+        name = name.encode( 'utf-8' )
+    return prefix + name.lower()
+
+def _encode( value ):
+    # JSON hands strings back as unicode; the snapshot, python-ldap and
+    # the keys here all use UTF-8 str, so non-ASCII DNs have to match
+    if isinstance( value, unicode ):
+        return value.encode( 'utf-8' )
+    if isinstance( value, list ):
+        return [ _encode( v ) for v in value ]
+    if isinstance( value, dict ):
+        return dict(
+            ( _encode( k ), _encode( v ) ) for k, v in value.iteritems()
+        )
+    return value
+
+def publish( path, snapshot, attrlist ):
+    """
+    writes the mapping for every person in snapshot, and attrlist for
+    every DN it holds, to a temporary file beside path and renames it
+    into place, so readers only ever map a complete file.
+    """
+    items = {}
+    for key, value in snapshot.people.iteritems():
+        name, accounts, is_pi = value
+        items[ _key( UID_PREFIX, key ) ] = [
+            name, list( accounts ) if accounts is not None else None, is_pi
+        ]
+    for dn, attrs in snapshot.by_dn.iteritems():
+        items[ _key( DN_PREFIX, dn ) ] = dict(
+            ( a, attrs[a] ) for a in attrlist if a in attrs
+        )
+
+    keys = sorted( items )
+    offset = HEADER.size + ENTRY.size * len( keys )
+    index = []
+    data = []
+    for key in keys:
+        value = json.dumps( items[ key ], separators=( ',', ':' ) )
+        index.append(
+            ENTRY.pack( offset, len( key ), offset + len( key ), len( value ) )
+        )
+        data.append( key )
+        data.append( value )
+        offset += len( key ) + len( value )
+
+    directory, name = os.path.split( os.path.abspath( path ) )
+    fd, tmp = tempfile.mkstemp( dir=directory, prefix='.' + name + '.' )
+    try:
+        f = os.fdopen( fd, 'wb' )
+        f.write( HEADER.pack(
+            MAGIC, VERSION, snapshot.generation, snapshot.built, len( keys )
+        ) )
+        f.write( ''.join( index ) )
+        f.write( ''.join( data ) )
+        f.flush()
+        os.fsync( f.fileno() )
+        f.close()
+        os.chmod( tmp, 0644 )
+        os.rename( tmp, path )
+    except:
+        os.unlink( tmp )
+        raise
+    logging.info(
+        "published %s shared map entries to %s", len( keys ), path
+    )
+
+class MappedSnapshot( object ):
+    """
+    read-only view of a published map file.  Offers the same lookup()
+    and age() as a Snapshot, plus attrs() for the DN attribute cache.
+    """
+    def __init__( self, path ):
+        f = open( path, 'rb' )
+        try:
+            self.stat = os.fstat( f.fileno() )
+            self._map = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+        finally:
+            f.close()
+
+        magic, version, self.generation, self.built, self.count = (
+            HEADER.unpack_from( self._map, 0 )
+        )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(
+                "%s is not a version %s shared map" % ( path, VERSION )
+            )
+
+    def _entry( self, i ):
+        ko, kl, vo, vl = ENTRY.unpack_from(
+            self._map, HEADER.size + i * ENTRY.size
+        )
+        return self._map[ ko:ko + kl ], vo, vl
+
+    def _value( self, vo, vl ):
+        return _encode( json.loads( self._map[ vo:vo + vl ] ) )
+
+    def _bisect( self, key ):
+        # index of the first entry not less than key
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = ( lo + hi ) // 2
+            if self._entry( mid )[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _get( self, key ):
+        i = self._bisect( key )
+        if i < self.count:
+            found, vo, vl = self._entry( i )
+            if found == key:
+                return self._value( vo, vl )
+        return None
+
+    def lookup( self, uid ):
+        value = self._get( _key( UID_PREFIX, uid ) )
+        if value is None:
+            return None
+        name, accounts, is_pi = value
+        return name, tuple( accounts ) if accounts is not None else None, is_pi
+
+    def attrs( self, dn ):
+        return self._get( _key( DN_PREFIX, dn ) )
+
+    def _scan( self, prefix ):
+        for i in xrange( self._bisect( prefix ), self.count ):
+            key, vo, vl = self._entry( i )
+            if not key.startswith( prefix ):
+                break
+            yield key[ len( prefix ): ], self._value( vo, vl )
+
+    def iterpeople( self ):
+        """
+        yields ( lower-cased username, ( name, accounts, is_pi ) ) for
+        every person in the file, in key order
+        """
+        for key, ( name, accounts, is_pi ) in self._scan( UID_PREFIX ):
+            yield key, (
+                name, tuple( accounts ) if accounts is not None else None, is_pi
+            )
+
+    def iterentries( self ):
+        """
+        yields ( lower-cased dn, attrs ) for every DN in the file
+        """
+        return self._scan( DN_PREFIX )
+
+    def age( self ):
+        return time.time() - self.built
+
+class SharedMap( object ):
+    """
+    the published map file as seen by one worker: remapped whenever a
+    new file has been renamed into place (checked at most once every
+    `check_interval` seconds).  A file that fails to map leaves the
+    previous one in use.
+    """
+    def __init__(
+        self, path, max_age=7200, check_interval=1, elect_interval=60
+    ):
+        self.path = path
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.elect_interval = elect_interval
+        self.current = None
+        self._checked = 0
+        self._elected = 0
+        self._lock = threading.Lock()
+        self._lockfile = None
+
+    def _refresh( self ):
+        now = time.time()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            st = os.stat( self.path )
+        except OSError:
+            return
+        current = self.current
+        if ( current is not None and
+             ( st.st_ino, st.st_mtime ) ==
+             ( current.stat.st_ino, current.stat.st_mtime ) ):
+            return
+        try:
+            self.current = MappedSnapshot( self.path )
+            logging.debug(
+                "mapped shared map generation %s", self.current.generation
+            )
+        except ( IOError, ValueError, struct.error, mmap.error ), e:
+            logging.error( "unable to map %s: %s", self.path, e )
+
+    def snapshot( self ):
+        """
+        returns the current MappedSnapshot, or None if there is none
+        younger than `max_age`
+        """
+        self._refresh()
+        current = self.current
+        if current is None or current.age() > self.max_age:
+            return None
+        return current
+
+    def elect( self ):
+        """
+        returns True if this process is (or has just become) the one
+        that builds and publishes the map
+        """
+        with self._lock:
+            if self._lockfile is not None:
+                return True
+            if time.time() - self._elected < self.elect_interval:
+                return False
+            self._elected = time.time()
+            f = open( self.path + '.lock', 'a' )
+            try:
+                fcntl.flock( f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB )
+            except IOError:
+                f.close()
+                return False
+            # held for the life of the process
+            self._lockfile = f
+            logging.info( "pid %s builds the shared map", os.getpid() )
+            return True
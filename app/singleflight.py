@@ -0,0 +1,78 @@
+# -*- coding: UTF-8 -*-
+
+import sys
+import threading
+
+class FlightTimeout( Exception ):
+    """
+    raised in a waiter when the shared call does not finish in time
+    """
+    pass
+
+class Call( object ):
+    """
+    one in-flight resolution and the outcome its waiters share
+    """
+    def __init__( self ):
+        self.result = None
+        self.error = None
+        self.waiters = 0
+        self._done = threading.Event()
+
+    def wait( self, timeout=None ):
+        if not self._done.wait( timeout ):
+            raise FlightTimeout(
+                "shared lookup did not finish within %s seconds" % timeout
+            )
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+class SingleFlight( object ):
+    """
+    coalesces concurrent calls for the same key: the first caller (the
+    leader) does the work and every caller arriving before it finishes
+    gets the same result, or the same exception.
+
+    begin()/finish() let a caller lead several keys with one batched
+    call; do() covers the single-key case.
+    """
+    def __init__( self ):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def begin( self, key ):
+        """
+        returns ( call, leader ).  A leader must always finish() the key.
+        """
+        with self._lock:
+            call = self._calls.get( key )
+            if call is not None:
+                call.waiters += 1
+                return call, False
+            call = Call()
+            self._calls[ key ] = call
+            return call, True
+
+    def finish( self, key, call, result=None, error=None ):
+        """
+        publishes result (or error, an exc_info tuple) to every waiter
+        """
+        with self._lock:
+            if self._calls.get( key ) is call:
+                del self._calls[ key ]
+        call.result = result
+        call.error = error
+        call._done.set()
+
+    def do( self, key, fn, timeout=None ):
+        call, leader = self.begin( key )
+        if not leader:
+            return call.wait( timeout )
+        try:
+            result = fn()
+        except:
+            self.finish( key, call, error=sys.exc_info() )
+            raise
+        self.finish( key, call, result )
+        return result
@@ -0,0 +1,221 @@
+# -*- coding: UTF-8 -*-
+
+import time
+import logging
+import threading
+
+import ldap
+
+from ldappool import paged_search
+from picache import PICache
+
+SNAPSHOT_FILTER = "(sAMAccountType=805306368)"
+SNAPSHOT_ATTRS = [
+    'sAMAccountName', 'manager', 'title', 'sn', 'givenName', 'fhcrcpaygroup'
+]
+
+class Incomplete( Exception ):
+    """
+    raised when resolving a person needs data the snapshot does not hold
+    """
+    pass
+
+class Snapshot( object ):
+    """
+    in-memory copy of the org chart, with the PI account of every
+    payroll user worked out up front.
+
+    `people` maps a lower-cased username to ( name, accounts, is_pi ),
+    where accounts is None when map_uid would return nothing for that
+    person.  People whose chain leaves the snapshot (or lacks a title,
+    sn or givenName), and usernames more than one payroll entry has,
+    are left out so a live lookup handles them.
+    """
+    def __init__( self, entries, pi_titles, maxtries, generation=0 ):
+        self.built = time.time()
+        self.generation = generation
+        self.pi_titles = pi_titles
+        self.maxtries = maxtries
+
+        self.by_dn = {}
+        self.users = {}
+        duplicates = set()
+        for dn, attrs in entries:
+            self.by_dn[ dn.lower() ] = attrs
+            try:
+                name = attrs['sAMAccountName'][0]
+            except KeyError:
+                continue
+            if attrs.get( 'fhcrcpaygroup', [ None ] )[0] == 'Y':
+                if name.lower() in self.users:
+                    duplicates.add( name.lower() )
+                self.users[ name.lower() ] = dn
+        for key in duplicates:
+            logging.debug( "%s is on more than one entry", key )
+            del self.users[ key ]
+
+        self.people = {}
+        memo = PICache( ttl=float( 'inf' ) )
+        for key, dn in self.users.iteritems():
+            try:
+                self.people[ key ] = self._resolve( dn, memo )
+            except Incomplete:
+                continue
+
+    def _attrs( self, dn ):
+        try:
+            return self.by_dn[ dn.lower() ]
+        except KeyError:
+            raise Incomplete( dn )
+
+    def _title( self, dn ):
+        try:
+            return self._attrs( dn )['title'][0]
+        except KeyError:
+            raise Incomplete( dn )
+
+    def _account( self, dn ):
+        attrs = self._attrs( dn )
+        try:
+            return (
+                attrs['sn'][0].lower() + "_" + attrs['givenName'][0].lower()[0],
+            )
+        except KeyError:
+            raise Incomplete( dn )
+
+    def _resolve( self, dn, memo ):
+        name = self._attrs( dn )['sAMAccountName'][0]
+        if self._title( dn ) in self.pi_titles:
+            return name, self._account( dn ), True
+
+        try:
+            dn = self._attrs( dn )['manager'][0]
+        except KeyError:
+            return name, None, False
+
+        # same walk (and MAXTRIES budget) as resolve_pis
+        path = []
+        for locate in range( self.maxtries ):
+            cached = memo.get( dn, self.maxtries - locate )
+            if cached is not None:
+                account, steps = cached
+                memo.compress( path, account, steps + 1 )
+                return name, tuple( account ), False
+
+            path.append( dn )
+            if self._title( dn ) in self.pi_titles:
+                break
+            try:
+                dn = self._attrs( dn )['manager'][0]
+            except KeyError:
+                break
+        else:
+            return name, None, False
+
+        account = self._account( dn )
+        memo.compress( path, account, 1 )
+        return name, account, False
+
+    def lookup( self, uid ):
+        """
+        returns ( name, accounts, is_pi ) for uid, or None on a miss
+        """
+        return self.people.get( uid.lower() )
+
+    def iterpeople( self ):
+        """
+        yields ( lower-cased username, ( name, accounts, is_pi ) ) for
+        every person resolved
+        """
+        return self.people.iteritems()
+
+    def iterentries( self ):
+        """
+        yields ( lower-cased dn, attrs ) for every entry read
+        """
+        return self.by_dn.iteritems()
+
+    def age( self ):
+        return time.time() - self.built
+
+class SnapshotRefresher( object ):
+    """
+    rebuilds the Snapshot every `interval` seconds in a background
+    thread.  The new snapshot is built aside and swapped in with one
+    assignment, so readers of `current` never wait on a rebuild.
+    `on_build`, if given, is called with each new snapshot.
+    """
+    def __init__(
+        self, pool, base, pi_titles, maxtries, interval=3600,
+        max_age=7200, page_size=500, on_build=None
+    ):
+        self.pool = pool
+        self.base = base
+        self.pi_titles = pi_titles
+        self.maxtries = maxtries
+        self.interval = interval
+        self.max_age = max_age
+        self.page_size = page_size
+        self.on_build = on_build
+        self.generation = 0
+        self.current = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def build( self ):
+        start = time.time()
+        with self.pool.connection() as l:
+            snapshot = Snapshot(
+                paged_search(
+                    l, self.base, ldap.SCOPE_SUBTREE, SNAPSHOT_FILTER,
+                    SNAPSHOT_ATTRS, self.page_size
+                ),
+                self.pi_titles,
+                self.maxtries,
+                # stays increasing across restarts of the process that
+                # publishes the shared map
+                max( self.generation + 1, int( time.time() ) )
+            )
+        self.generation = snapshot.generation
+        self.current = snapshot
+        logging.info(
+            "directory snapshot %s: %s entries, %s people in %.1f seconds",
+            snapshot.generation, len( snapshot.by_dn ),
+            len( snapshot.people ), time.time() - start
+        )
+        if self.on_build is not None:
+            self.on_build( snapshot )
+
+    def _run( self ):
+        while True:
+            try:
+                self.build()
+            except Exception, e:
+                logging.exception( "directory snapshot rebuild failed: %s", e )
+            time.sleep( self.interval )
+
+    def start( self ):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='snapshot-refresh'
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def snapshot( self ):
+        """
+        returns the current snapshot, or None if there is none younger
+        than `max_age`
+        """
+        snapshot = self.current
+        if snapshot is None or snapshot.age() > self.max_age:
+            return None
+        return snapshot
+
+    def age( self ):
+        snapshot = self.current
+        if snapshot is None:
+            return None
+        return snapshot.age()
@@ -0,0 +1,147 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import tempfile
+import threading
+
+# the mapping table idmgr writes: one row per username holding the
+# accounts the directory gives it (overrides are applied on lookup) and
+# whether it is a PI, plus the layout version, generation and build
+# time in meta
+VERSION = 2
+SCHEMA = [
+    "create table mapping ( "
+    "username text primary key collate nocase, alist text, adef text, "
+    "pi integer )",
+    "create table meta ( key text primary key, value )",
+]
+
+def write( path, rows, generation=None ):
+    """
+    writes ( username, alist, adef, is_pi ) rows to a new store beside
+    path and renames it into place, so readers only ever open a
+    complete file
+    """
+    if generation is None:
+        generation = int( time.time() )
+    directory, name = os.path.split( os.path.abspath( path ) )
+    fd, tmp = tempfile.mkstemp( dir=directory, prefix='.' + name + '.' )
+    os.close( fd )
+    try:
+        db = sqlite3.connect( tmp )
+        for statement in SCHEMA:
+            db.execute( statement )
+        db.executemany(
+            "insert or replace into mapping values ( ?, ?, ?, ? )",
+            (
+                ( username, json.dumps( list( alist ) ), adef, int( is_pi ) )
+                for username, alist, adef, is_pi in rows
+            )
+        )
+        db.executemany(
+            "insert into meta values ( ?, ? )",
+            [
+                ( 'version', VERSION ),
+                ( 'generation', generation ),
+                ( 'built', time.time() ),
+            ]
+        )
+        db.commit()
+        db.close()
+        os.chmod( tmp, 0644 )
+        os.rename( tmp, path )
+    except:
+        os.unlink( tmp )
+        raise
+
+class MappingStore( object ):
+    """
+    read side of the store: lookups against the newest file renamed
+    into place (checked at most once every `check_interval` seconds),
+    each thread with its own connection.  A store older than `max_age`
+    seconds, or written in another layout, is treated as missing.
+    """
+    def __init__( self, path, max_age=86400, check_interval=1 ):
+        self.path = path
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.generation = None
+        self.built = None
+        self._stat = None
+        self._bad = None
+        self._checked = 0
+        self._local = threading.local()
+
+    def _refresh( self ):
+        now = time.time()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            st = os.stat( self.path )
+        except OSError:
+            self._stat = None
+            return
+        stat = ( st.st_ino, st.st_mtime )
+        if stat == self._stat or stat == self._bad:
+            return
+        try:
+            db = sqlite3.connect( self.path )
+            meta = dict( db.execute( "select key, value from meta" ) )
+            db.close()
+            if int( meta.get( 'version', 1 ) ) != VERSION:
+                raise ValueError(
+                    "layout version %s, not %s" % (
+                        meta.get( 'version', 1 ), VERSION
+                    )
+                )
+            self.generation = int( meta[ 'generation' ] )
+            self.built = float( meta[ 'built' ] )
+        except ( sqlite3.Error, KeyError, ValueError ), e:
+            logging.error( "unable to read mapping store %s: %s", self.path, e )
+            # not used until a readable one replaces it
+            self._stat = None
+            self._bad = stat
+            return
+        self._stat = stat
+        logging.info(
+            "mapping store %s is generation %s", self.path, self.generation
+        )
+
+    def _db( self ):
+        # reopened once a newer file has been renamed into place
+        if getattr( self._local, 'stat', None ) != self._stat:
+            if getattr( self._local, 'db', None ) is not None:
+                self._local.db.close()
+            self._local.db = sqlite3.connect( self.path )
+            self._local.stat = self._stat
+        return self._local.db
+
+    def fresh( self ):
+        """
+        True if there is a store younger than `max_age`
+        """
+        self._refresh()
+        return self._stat is not None and self.age() <= self.max_age
+
+    def age( self ):
+        if self.built is None:
+            return None
+        return time.time() - self.built
+
+    def lookup( self, uid ):
+        """
+        returns ( username, alist, adef, is_pi ) for uid, or None on a miss
+        """
+        row = self._db().execute(
+            "select username, alist, adef, pi from mapping where username = ?",
+            ( uid, )
+        ).fetchone()
+        if row is None:
+            return None
+        username, alist, adef, is_pi = row
+        return username, json.loads( alist ), adef, bool( is_pi )
@@ -6,12 +6,24 @@ import yaml
 import json
 import argparse
 import os.path
+import ldap.dn
+import sqlite3
 
 import logging
 
 from collections import defaultdict
+from collections import deque
 from datetime import datetime
 
+# paged search, directory sync and the mapping store are shared with
+# the web app
+sys.path.insert(
+    0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'app' )
+)
+import dirsync
+import ldappool
+import store
+
 class IDAccount( object ):
     def __init__( self, username="", alist=[], adef="" ):
         self.username = username
@@ -28,7 +40,7 @@ class IDAccount( object ):
 class Person( object ):
     def __init__(
         self, dn="", username="", fullname="",
-        title="", manager="", reports = []
+        title="", manager="", reports = [], depth=0
     ):
         self.dn = dn
         self.username = username
@@ -36,6 +48,10 @@ class Person( object ):
         self.title = title
         self.manager = manager
         self.reports = reports
+        # managers up to the faculty member whose reports this is in
+        self.depth = depth
+        self.account = ""
+        self.payroll = False
 
     def __repr__( self ):
         #ret = ", ".join( [ self.username, ":".join( self.reports ) ] )
@@ -70,6 +86,18 @@ class Person( object ):
             self.reports = result[1]['directReports']
         except KeyError:
             self.reports = []
+        try:
+            # the account the web app generates for a PI
+            self.account = (
+                result[1]['sn'][0].lower() + "_" +
+                result[1]['givenName'][0].lower()[0]
+            )
+        except ( KeyError, IndexError ):
+            self.account = ""
+        try:
+            self.payroll = result[1]['fhcrcpaygroup'][0].upper() == 'Y'
+        except KeyError:
+            self.payroll = False
 
     def hasReports( self ):
         if len( self.reports ) > 0:
@@ -78,26 +106,21 @@ class Person( object ):
             return False
 
     def isInReports( self, search_term ):
-        dn = ""
-        username = ""
-        try:
-            tmp = DN.explode_dn( search_term )
-            dn = search_term
-        except:
-            username = search_term
-
-        if dn:
-            for report in self.reports:
-                if report.dn == dn:
-                    return True
-            return False
-        elif username:
-            for report in self.reports:
-                if report.username == username:
-                    return True
-            return False
-        else:
+        # search_term is a DN or a username; reports holds DNs as read
+        # from the directory, or Person records once they are walked
+        if not search_term:
             raise ValueError( "DN or username not specified" )
+        by_dn = ldap.dn.is_dn( search_term )
+        for report in self.reports:
+            if isinstance( report, Person ):
+                found = report.dn if by_dn else report.username
+            elif by_dn:
+                found = report
+            else:
+                continue
+            if found.lower() == search_term.lower():
+                return True
+        return False
 
 def account_name( fullname ):
     # Clean up display name- sometimes the title is included-
@@ -130,6 +153,46 @@ p.add_argument(
     default = False,
     help = 'Log errors to a file'
 )
+p.add_argument(
+    '--store',
+    type = str,
+    default = None,
+    help = 'Also write the mapping to this SQLite store for the web app ' +
+           '(default: MAPPING_STORE from the configuration)'
+)
+p.add_argument(
+    '--window',
+    type = int,
+    default = 16,
+    help = 'Number of report searches to keep outstanding at once'
+)
+p.add_argument(
+    '--page-size',
+    type = int,
+    default = None,
+    help = 'Entries per page of directory searches ' +
+           '(default: LDAP_PAGE_SIZE from the configuration, or 500)'
+)
+p.add_argument(
+    '--incremental',
+    dest='incremental',
+    action='store_true',
+    help='Keep a local copy of the directory and only read what ' +
+         'changed since the last run'
+)
+p.add_argument(
+    '--full-sync',
+    dest='full_sync',
+    action='store_true',
+    help='With --incremental, read the whole directory this run'
+)
+p.add_argument(
+    '--sync-state',
+    type = str,
+    default = None,
+    help = 'Where --incremental keeps its copy (default: ' +
+           '<script>.sync in SYNC_STATE_DIR from the configuration)'
+)
 p.add_argument(
     '--debug',
     dest='dbglvl',
@@ -144,7 +207,7 @@ p.add_argument(
     'all',
     action='store'
 )
-p.set_defaults( dbglvl=False )
+p.set_defaults( dbglvl=False, incremental=False, full_sync=False )
 
 args = p.parse_args()
 
@@ -173,6 +236,9 @@ except IOError:
     )
     sys.exit( 1 )
 
+if args.page_size is None:
+    args.page_size = config.get( 'LDAP_PAGE_SIZE', 500 )
+
 if args.logfile:
     errlog = logging.FileHandler( args.logfile )
     errlog.setLevel( logging.INFO )
@@ -186,6 +252,9 @@ logger.info( 'starting at ' +
            ' with config ' + args.config )
 
 ADServer = config['LDAP_SERVER']
+if type( ADServer ) is list:
+    # libldap tries each URI in a space-separated list in turn
+    ADServer = " ".join( ADServer )
 ADSearchBase = config['LDAP_SEARCH_BASE']
 ADSearchScope = ldap.SCOPE_SUBTREE
 
@@ -219,35 +288,94 @@ Attrs = [
     "directReports",
     "title",
     "manager",
-    "sAMAccountName"
+    "sAMAccountName",
+    "sn",
+    "givenName",
+    "fhcrcpaygroup"
 ]
 
+PersonFilter = "(&(sAMAccountType=805306368)(objectClass=user))"
+
 faculty = defaultdict()
 
-try:
-    search = l.search( ADSearchBase, ADSearchScope, MemberFilter, Attrs  )
-    t, results = l.result( search, 60 )
-except ldap.NO_SUCH_OBJECT, e:
-    logger.error(
-        "search base ( %s ) not found on server", ADSearchBase
+def search_entries( filterstr ):
+    # entries under the search base, read args.page_size at a time with
+    # the Simple Paged Results control so AD's MaxPageSize cannot
+    # truncate them and only one page is held at once
+    try:
+        for entry in ldappool.paged_search(
+            l, ADSearchBase, ADSearchScope, filterstr, Attrs, args.page_size
+        ):
+            yield entry
+    except ldap.NO_SUCH_OBJECT, e:
+        logger.error(
+            "search base ( %s ) not found on server", ADSearchBase
+        )
+        logger.debug( e )
+        sys.exit(1)
+    except ldap.REFERRAL, e:
+        logger.error(
+            "referral for search base ( %s ) required "+ 
+            "but referrals are disabled ",
+            ADSearchBase
+        )
+        logger.debug( e )
+        sys.exit(1)
+    except Exception:
+        e = sys.exc_info()
+        logger.error( e[0] )
+        logger.exception( e[1] )
+        sys.exit(1)
+
+def synced_directory():
+    # every person under the search base, from the local copy brought
+    # up to date with the entries changed since the last run
+    state = args.sync_state or os.path.join(
+        config.get( 'SYNC_STATE_DIR', '.' ),
+        os.path.basename( sys.argv[0] ) + '.sync'
     )
-    logger.debug( e )
-    sys.exit(1)
-except ldap.REFERRAL, e:
-    logger.error(
-        "referral for search base ( %s ) required "+ 
-        "but referrals are disabled ",
-        ADSearchBase
+    sync = dirsync.DirectorySync(
+        state, ADSearchBase, PersonFilter, Attrs, args.page_size,
+        config.get( 'SYNC_FULL_INTERVAL', 604800 )
+    )
+    try:
+        return sync.sync( l, args.full_sync )
+    except ( ldap.LDAPError, IOError, OSError ), e:
+        logger.error( "directory sync failed: %s", e )
+        sys.exit(1)
+
+def faculty_entries():
+    # the PI search, answered from the synced directory with --incremental
+    if directory is None or not args.incremental:
+        return search_entries( MemberFilter )
+    titles = set( title.lower() for title in MemberList )
+    return (
+        dirsync.lookup( directory, ADSearchBase, dn )[0]
+        for dn, attrs in directory.values()
+        if attrs.get( 'title', [ '' ] )[0].lower() in titles
     )
-    logger.debug( e )
-    sys.exit(1)
-except:
-    e = sys.exc_info()
-    logger.error( e[0] )
-    logger.exception( e[1] )
-    sys.exit(1)
 
-for result in results:
+# with --incremental, every person under the search base by lower-cased DN
+directory = None
+if args.incremental:
+    directory = synced_directory()
+
+def issue_report( report ):
+    # the entries for report if the synced directory has them, else the
+    # msgid of the SCOPE_BASE search sent for it
+    if directory is not None:
+        found = dirsync.lookup( directory, ADSearchBase, report )
+        if found is not None:
+            return found, None
+    return None, l.search(
+        base = report,
+        scope = ldap.SCOPE_BASE,
+        filterstr = PersonFilter,
+        attrlist = Attrs
+    )
+
+# Person records are built as each page arrives
+for result in faculty_entries():
     if not result[0]:
         continue
     logger.debug( "working on %s", result[0])
@@ -262,30 +390,31 @@ for u, person in faculty.iteritems():
     logger.debug(
         "getting reports for faculty member %s", person.username
     )
-    i = 0
+    # reports still to look up, in the order the walk finds them, with
+    # searches outstanding for up to args.window of them and results
+    # read in that order.  A DN reached twice is only looked up once
+    queue = deque( ( report, 1 ) for report in person.reports )
+    seen = set()
+    pending = deque()
+    reports = []
     while True:
-        try:
-            report = person.reports[i]
-        except IndexError:
+        while len( pending ) < max( 1, args.window ) and queue:
+            ahead, depth = queue.popleft()
+            if ahead in seen:
+                continue
+            seen.add( ahead )
+            pending.append( ( ahead, depth, issue_report( ahead ) ) )
+        if not pending:
             break
 
-        i = i + 1
+        report, depth, ( result, search ) = pending.popleft()
 
         logger.debug( "getting info on report %s", report)
-        search = l.search(
-            base = report,
-            scope = ldap.SCOPE_BASE,
-            filterstr = "(&(sAMAccountType=805306368)(objectClass=user))",
-            attrlist = Attrs
-        )
-        t, result = l.result( search, 60 )
+        if search is not None:
+            t, result = l.result( search, 60 )
 
         if len( result ) == 0:
             logger.debug( "%s is non person account", report )
-            # remove non-person account from list of reports
-            # and rewind index by one to account for its removal
-            person.reports.remove( report )
-            i = i - 1
             continue
 
         tmp = Person()
@@ -294,19 +423,21 @@ for u, person in faculty.iteritems():
         except:
             logger.error( "Failed creating %s", result )
             sys.exit(1)
+        tmp.depth = depth
 
-        record = person.reports.index( report )
-        person.reports[record] = tmp
+        reports.append( tmp )
 
         if tmp.hasReports():
             logger.debug( "found report with reports: %s", tmp.username )
             if tmp.title not in MemberList:
                 logger.debug( "adding %s reports to %s",
                               tmp.username, person.username )
-                person.reports = person.reports + tmp.reports
+                queue.extend( ( r, depth + 1 ) for r in tmp.reports )
             else:
                 logger.debug( "report is faculty member- skipping reports" )
 
+    person.reports = reports
+
 accounts = defaultdict()
 
 for member in faculty.values():
@@ -395,6 +526,49 @@ for o in overrides:
 for account in accounts.values():
     print account.format()
 
+def store_rows():
+    # the rows the web app answers from in place of its live lookup, so
+    # each must be what map_uid would return before overrides (the app
+    # applies those): a PI gets their own account and anyone else the
+    # account of the first PI up their manager chain, if that is no
+    # more than MAXTRIES managers up.  Only payroll users are mapped.
+    # Usernames found under more than one DN, people under a member
+    # whose title only matched the search case-insensitively, and
+    # everyone not walked here are left to the live lookup
+    maxtries = config['MAXTRIES']
+    found = defaultdict( dict )
+    for member in faculty.values():
+        if member.title not in MemberList or not member.account:
+            continue
+        if member.username and member.payroll:
+            found[ member.username.lower() ][ member.dn.lower() ] = (
+                member.username, [ member.account ], member.account, True
+            )
+        for report in member.reports:
+            if ( not report.username or not report.payroll or
+                 report.title in MemberList or report.depth > maxtries ):
+                continue
+            found[ report.username.lower() ][ report.dn.lower() ] = (
+                report.username, [ member.account ], member.account, False
+            )
+    for username, rows in found.iteritems():
+        if len( rows ) == 1:
+            yield rows.values()[0]
+        else:
+            logger.debug(
+                "%s found %s times- left to the live lookup",
+                username, len( rows )
+            )
+
+store_path = args.store or config.get( 'MAPPING_STORE' )
+if store_path:
+    try:
+        store.write( store_path, store_rows() )
+        logger.info( 'Wrote mapping store %s', store_path )
+    except ( IOError, OSError, sqlite3.Error ), e:
+        logger.error( "unable to write mapping store %s: %s", store_path, e )
+        sys.exit( 1 )
+
 time['end'] = datetime.today()
 logger.info(
     'Wrote %s credentials in %s seconds',
@@ -6,12 +6,22 @@ import yaml
 import json
 import argparse
 import os.path
+import ldap.dn
 
 import logging
 
 from collections import defaultdict
+from collections import deque
+from collections import OrderedDict
 from datetime import datetime
 
+# paged search and directory sync are shared with the web app
+sys.path.insert(
+    0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'app' )
+)
+import dirsync
+import ldappool
+
 import subprocess
 
 class Person( object ):
@@ -74,34 +84,46 @@ class Person( object ):
             return False
 
     def isInReports( self, search_term ):
-        dn = ""
-        username = ""
-        try:
-            tmp = DN.explode_dn( search_term )
-            dn = search_term
-        except:
-            username = search_term
-
-        if dn:
-            for report in self.reports:
-                if report.dn == dn:
-                    return True
-            return False
-        elif username:
-            for report in self.reports:
-                if report.username == username:
-                    return True
-            return False
-        else:
+        # search_term is a DN or a username; reports holds DNs as read
+        # from the directory, or Person records once they are walked
+        if not search_term:
             raise ValueError( "DN or username not specified" )
+        by_dn = ldap.dn.is_dn( search_term )
+        for report in self.reports:
+            if isinstance( report, Person ):
+                found = report.dn if by_dn else report.username
+            elif by_dn:
+                found = report
+            else:
+                continue
+            if found.lower() == search_term.lower():
+                return True
+        return False
+
+class OrderedSet( object ):
+    # a set that iterates in the order items were first added
+    def __init__( self, items = () ):
+        self._items = OrderedDict()
+        for item in items:
+            self.add( item )
+
+    def add( self, item ):
+        self._items[ item ] = None
+
+    def __contains__( self, item ):
+        return item in self._items
 
-        return retval
+    def __iter__( self ):
+        return iter( self._items )
+
+    def __len__( self ):
+        return len( self._items )
 
 class Account( object ):
-    def __init__( self, name = None, owner = None, members = []):
+    def __init__( self, name = None, owner = None, members = () ):
         self.name = name
         self.owner = owner
-        self.members = members
+        self.members = OrderedSet( members )
 
     def username( self ):
         return self.owner.username
@@ -113,10 +135,7 @@ class Account( object ):
         return self.owner.division
 
     def append_member( self, name ):
-        if name not in self.members:
-            self.members.append( name )
-
-        return
+        self.members.add( name )
 
     def account_name( self ):
         if self.name is None:
@@ -192,6 +211,44 @@ p.add_argument(
     default = False,
     help = 'Log errors to a file'
 )
+p.add_argument(
+    '--bulk',
+    dest='bulk',
+    action='store_true',
+    help='Read every user in one paged search instead of one search per report'
+)
+p.add_argument(
+    '--no-bulk',
+    dest='bulk',
+    action='store_false'
+)
+p.add_argument(
+    '--page-size',
+    type = int,
+    default = None,
+    help = 'Entries per page of directory searches ' +
+           '(default: LDAP_PAGE_SIZE from the configuration, or 500)'
+)
+p.add_argument(
+    '--incremental',
+    dest='incremental',
+    action='store_true',
+    help='Keep a local copy of the directory and only read what ' +
+         'changed since the last run'
+)
+p.add_argument(
+    '--full-sync',
+    dest='full_sync',
+    action='store_true',
+    help='With --incremental, read the whole directory this run'
+)
+p.add_argument(
+    '--sync-state',
+    type = str,
+    default = None,
+    help = 'Where --incremental keeps its copy (default: ' +
+           '<script>.sync in SYNC_STATE_DIR from the configuration)'
+)
 p.add_argument(
     '--debug',
     dest='dbglvl',
@@ -206,7 +263,7 @@ p.add_argument(
     'all',
     action='store'
 )
-p.set_defaults( dbglvl=False )
+p.set_defaults( dbglvl=False, incremental=False, full_sync=False, bulk=False )
 
 args = p.parse_args()
 
@@ -235,6 +292,9 @@ except IOError:
     )
     sys.exit( 1 )
 
+if args.page_size is None:
+    args.page_size = config.get( 'LDAP_PAGE_SIZE', 500 )
+
 if args.logfile:
     errlog = logging.FileHandler( args.logfile )
     errlog.setLevel( logging.INFO )
@@ -248,6 +308,9 @@ logger.info( 'starting at ' +
            ' with config ' + args.config )
 
 ADServer = config['LDAP_SERVER']
+if type( ADServer ) is list:
+    # libldap tries each URI in a space-separated list in turn
+    ADServer = " ".join( ADServer )
 ADSearchBase = config['LDAP_SEARCH_BASE']
 ADSearchScope = ldap.SCOPE_SUBTREE
 
@@ -274,6 +337,8 @@ for title in MemberList:
     MemberFilter = MemberFilter + "(title=" + title + ")"
 MemberFilter = MemberFilter + "))"
 
+PersonFilter = "(&(sAMAccountType=805306368)(objectClass=user))"
+
 Attrs = [
     "displayName",
     "directReports",
@@ -284,33 +349,96 @@ Attrs = [
 ]
 
 
-try:
-    search = l.search( ADSearchBase, ADSearchScope, MemberFilter, Attrs  )
-    t, results = l.result( search, 60 )
-except ldap.NO_SUCH_OBJECT, e:
-    logger.error(
-        "search base ( %s ) not found on server", ADSearchBase
+def search_entries( filterstr ):
+    # entries under the search base, read args.page_size at a time with
+    # the Simple Paged Results control so AD's MaxPageSize cannot
+    # truncate them and only one page is held at once
+    try:
+        for entry in ldappool.paged_search(
+            l, ADSearchBase, ADSearchScope, filterstr, Attrs, args.page_size
+        ):
+            yield entry
+    except ldap.NO_SUCH_OBJECT, e:
+        logger.error(
+            "search base ( %s ) not found on server", ADSearchBase
+        )
+        logger.debug( e )
+        sys.exit(1)
+    except ldap.REFERRAL, e:
+        logger.error(
+            "referral for search base ( %s ) required "+ 
+            "but referrals are disabled ",
+            ADSearchBase
+        )
+        logger.debug( e )
+        sys.exit(1)
+    except Exception:
+        e = sys.exc_info()
+        logger.error( e[0] )
+        logger.exception( e[1] )
+        sys.exit(1)
+
+def synced_directory():
+    # every person under the search base, from the local copy brought
+    # up to date with the entries changed since the last run
+    state = args.sync_state or os.path.join(
+        config.get( 'SYNC_STATE_DIR', '.' ),
+        os.path.basename( sys.argv[0] ) + '.sync'
     )
-    logger.debug( e )
-    sys.exit(1)
-except ldap.REFERRAL, e:
-    logger.error(
-        "referral for search base ( %s ) required "+ 
-        "but referrals are disabled ",
-        ADSearchBase
+    sync = dirsync.DirectorySync(
+        state, ADSearchBase, PersonFilter, Attrs, args.page_size,
+        config.get( 'SYNC_FULL_INTERVAL', 604800 )
     )
-    logger.debug( e )
-    sys.exit(1)
-except:
-    e = sys.exc_info()
-    logger.error( e[0] )
-    logger.exception( e[1] )
-    sys.exit(1)
+    try:
+        return sync.sync( l, args.full_sync )
+    except ( ldap.LDAPError, IOError, OSError ), e:
+        logger.error( "directory sync failed: %s", e )
+        sys.exit(1)
+
+def faculty_entries():
+    # the PI search, answered from the synced directory with --incremental
+    if directory is None or not args.incremental:
+        return search_entries( MemberFilter )
+    titles = set( title.lower() for title in MemberList )
+    return (
+        dirsync.lookup( directory, ADSearchBase, dn )[0]
+        for dn, attrs in directory.values()
+        if attrs.get( 'title', [ '' ] )[0].lower() in titles
+    )
+
+# with --bulk or --incremental, every person under the search base by
+# lower-cased DN
+directory = None
+if args.incremental:
+    directory = synced_directory()
+elif args.bulk:
+    directory = {}
+    for dn, attrs in search_entries( PersonFilter ):
+        directory[ dn.lower() ] = ( dn, attrs )
+    logger.debug( "read %s users in bulk", len( directory ) )
+
+def find_report( report ):
+    # the entries a SCOPE_BASE search for report would return, from the
+    # directory when there is one and report lies under the search base
+    if directory is not None:
+        result = dirsync.lookup( directory, ADSearchBase, report )
+        if result is not None:
+            return result
+
+    search = l.search(
+        base = report,
+        scope = ldap.SCOPE_BASE,
+        filterstr = PersonFilter,
+        attrlist = Attrs
+    )
+    t, result = l.result( search, 60 )
+    return result
 
 accounts = defaultdict()
 people = defaultdict()
 
-for result in results:
+# Person records are built as each page arrives
+for result in faculty_entries():
     if not result[0]:
         continue
     logger.debug( "working on %s", result[0])
@@ -318,7 +446,7 @@ for result in results:
     member = Person()
     member.create( result )
 
-    account = Account( owner = member, members=member.reports )
+    account = Account( owner = member )
     accounts[ account.account_name() ] = account
 
     people[ member.username ] = member
@@ -328,30 +456,21 @@ for u, account in accounts.iteritems():
     logger.debug(
         "getting reports for faculty member %s", account.owner.username
     )
-    i = 0
-    while True:
-        try:
-            report = account.members[i]
-        except IndexError:
-            break
-
-        i = i + 1
+    # reports still to look up, in the order the walk finds them; a DN
+    # reached twice is only looked up (and expanded) once
+    queue = deque( account.owner.reports )
+    seen = set()
+    while queue:
+        report = queue.popleft()
+        if report in seen:
+            continue
+        seen.add( report )
 
         logger.debug( "getting info on report %s", report)
-        search = l.search(
-            base = report,
-            scope = ldap.SCOPE_BASE,
-            filterstr = "(&(sAMAccountType=805306368)(objectClass=user))",
-            attrlist = Attrs
-        )
-        t, result = l.result( search, 60 )
+        result = find_report( report )
 
         if len( result ) == 0:
             logger.debug( "%s is non person account", report )
-            # remove non-person account from list of reports
-            # and rewind index by one to account for its removal
-            account.members.remove( report )
-            i = i - 1
             continue
 
         tmp = Person()
@@ -361,8 +480,7 @@ for u, account in accounts.iteritems():
             logger.error( "Failed creating %s", result )
             sys.exit(1)
 
-        record = account.members.index( report )
-        account.members[record] = tmp.username
+        account.append_member( tmp.username )
         if tmp.username not in people:
             people[ tmp.username ] = tmp
             people[ tmp.username ].adef = account.account_name()
@@ -376,13 +494,12 @@ for u, account in accounts.iteritems():
                 logger.debug( "adding %s's reports to %s (%s)",
                               tmp.username, account.owner.username,
                             tmp.reports )
-                account.members = account.members + tmp.reports
+                queue.extend( tmp.reports )
             else:
                 logger.debug( "report is faculty member- skipping reports" )
 
     logger.debug("done with for faculty member %s", account.owner.username)
 
-
 overrides = yaml.load_all( file( config['OVERRIDES'], 'r' ) )
 logger.debug("processing account overrides")
 for o in overrides:
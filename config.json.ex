@@ -10,11 +10,67 @@
 ],
 "OVERRIDES" : "etc/overrides.yaml",
 
-"LDAP_SERVER" : "ldap://ldap.domain.fu",
+"LDAP_SERVER" : [ "ldap://ldap1.domain.fu", "ldap://ldap2.domain.fu" ],
 "LDAP_SEARCH_BASE" : "dc=domain,dc=fu",
 
+"LDAP_POOL_SIZE" : 4,
+"LDAP_POOL_TIMEOUT" : 10,
+"LDAP_POOL_MAX_AGE" : 600,
+"LDAP_POOL_CHECK_INTERVAL" : 30,
+"LDAP_NETWORK_TIMEOUT" : 10,
+"LDAP_FILTER_BATCH" : 100,
+"LDAP_EJECT_SECONDS" : 30,
+"LDAP_HEDGE_PERCENTILE" : 95,
+
+"DN_CACHE_SIZE" : 10000,
+"DN_CACHE_TTL" : 300,
+"PI_CACHE_TTL" : 300,
+"NEGATIVE_CACHE_SIZE" : 10000,
+"NEGATIVE_CACHE_TTL" : 60,
+
+"FAST_REJECT" : false,
+"FAST_REJECT_REFRESH" : 900,
+"LDAP_PAGE_SIZE" : 500,
+
+"SYNC_STATE_DIR" : "/var/tmp",
+"SYNC_FULL_INTERVAL" : 604800,
+
+"SINGLEFLIGHT_TIMEOUT" : 60,
+"REQUEST_TIMEOUT" : 30,
+"REQUEST_TIMEOUT_MAX" : 120,
+"LDAP_TIMEOUT" : 60,
+
+"SNAPSHOT" : false,
+"SNAPSHOT_REFRESH" : 3600,
+"SNAPSHOT_MAX_AGE" : 7200,
+"SHARED_MAP" : "",
+
+"MAPPING_STORE" : "",
+"MAPPING_STORE_MAX_AGE" : 86400,
+
+"BATCH_MAX_UIDS" : 5000,
+"BATCH_WORKERS" : 8,
+"BATCH_CONCURRENCY" : 4,
+"BATCH_CHUNK" : 25,
+
+"REST_MAX_AGE" : 60,
+"REST_ETAG_TTL" : 300,
+"MEMBERS_PAGE_SIZE" : 100,
+"MEMBERS_PAGE_MAX" : 1000,
+
+"JOB_THRESHOLD" : 200,
+"JOB_WORKERS" : 2,
+"JOB_QUEUE_SIZE" : 20,
+"JOB_TTL" : 3600,
+"JOB_RETRY_AFTER" : 30,
+"JOB_STORE" : "",
+
 "BINDDN" : "NDDNIB"
 "BINDPW" : "WPDNIB",
 
+"LOG_LEVEL" : "INFO",
+
+"GEVENT_THREADS" : 20,
+"GEVENT_CONNECTIONS" : 1000,
 "DEBUG" : false
 }
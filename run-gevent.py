@@ -0,0 +1,20 @@
+#!virtenv/bin/python
+# serves the app from one gevent process: requests run as greenlets and
+# the blocking python-ldap calls go to a bounded thread pool, so many
+# lookups can be waiting on LDAP at once
+from gevent import monkey
+monkey.patch_all()
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from app import app
+from app import offload
+
+offload.configure( app.config.get( 'GEVENT_THREADS', 20 ) )
+
+WSGIServer(
+    ( '0.0.0.0', app.config['PORT'] ),
+    app,
+    spawn = Pool( app.config.get( 'GEVENT_CONNECTIONS', 1000 ) )
+).serve_forever()
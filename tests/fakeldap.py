@@ -0,0 +1,253 @@
+# -*- coding: UTF-8 -*-
+
+# an in-memory stand-in for the parts of python-ldap the app uses.
+# install() puts it in sys.modules as ldap (and its submodules) before
+# anything imports the real one; the directory served is DIRECTORY,
+# lower-cased DN -> ( dn, attrs ).
+#
+# every server (uri) serves the same directory.  LATENCY delays a
+# server's search results, DOWN makes it refuse binds and searches, and
+# a search on a FAILING server ends in SERVER_DOWN once it is due.
+
+import re
+import sys
+import time
+import types
+import threading
+
+DIRECTORY = {}
+LATENCY = {}
+DOWN = set()
+FAILING = set()
+
+SCOPE_BASE = 0
+SCOPE_ONELEVEL = 1
+SCOPE_SUBTREE = 2
+RES_ANY = -1
+RES_SEARCH_RESULT = 101
+OPT_REFERRALS = 8
+OPT_NETWORK_TIMEOUT = 20485
+
+class LDAPError( Exception ):
+    pass
+
+class SERVER_DOWN( LDAPError ):
+    pass
+
+class CONNECT_ERROR( LDAPError ):
+    pass
+
+class TIMEOUT( LDAPError ):
+    pass
+
+class NO_SUCH_OBJECT( LDAPError ):
+    pass
+
+class INVALID_CREDENTIALS( LDAPError ):
+    pass
+
+class REFERRAL( LDAPError ):
+    pass
+
+def add( dn, **attrs ):
+    """
+    puts an entry in the directory; attribute values become lists
+    """
+    DIRECTORY[ dn.lower() ] = ( dn, dict(
+        ( name, value if isinstance( value, list ) else [ value ] )
+        for name, value in attrs.iteritems()
+    ) )
+
+def escape_filter_chars( value, escape_mode=0 ):
+    return re.sub(
+        r'[\\*()\x00]', lambda m: '\\%02x' % ord( m.group( 0 ) ), value
+    )
+
+def _unescape( value ):
+    return re.sub(
+        r'\\([0-9a-fA-F]{2})', lambda m: chr( int( m.group( 1 ), 16 ) ), value
+    )
+
+def _parse( filterstr, i=0 ):
+    # returns ( test, end ) for the filter starting at filterstr[i]
+    assert filterstr[i] == '('
+    op = filterstr[ i + 1 ]
+    if op in '&|!':
+        i += 2
+        terms = []
+        while filterstr[i] == '(':
+            term, i = _parse( filterstr, i )
+            terms.append( term )
+        if op == '&':
+            test = lambda attrs: all( t( attrs ) for t in terms )
+        elif op == '|':
+            test = lambda attrs: any( t( attrs ) for t in terms )
+        else:
+            test = lambda attrs: not terms[0]( attrs )
+        return test, i + 1
+    end = filterstr.index( ')', i )
+    m = re.match( r'([\w.-]+)(>=|<=|=)(.*)', filterstr[ i + 1:end ] )
+    name, cmp, value = m.group( 1 ).lower(), m.group( 2 ), m.group( 3 )
+    def test( attrs ):
+        values = [ v for a, v in attrs.iteritems() if a.lower() == name ]
+        values = values[0] if values else []
+        if cmp == '>=':
+            return any( int( v ) >= int( value ) for v in values )
+        if cmp == '<=':
+            return any( int( v ) <= int( value ) for v in values )
+        if value == '*':
+            return bool( values )
+        wanted = _unescape( value ).lower()
+        return any( v.lower() == wanted for v in values )
+    return test, end + 1
+
+def _under( dn, base ):
+    dn, base = dn.lower(), base.lower()
+    return not base or dn == base or dn.endswith( ',' + base )
+
+class FakeLDAPObject( object ):
+    def __init__( self, uri ):
+        self.uri = uri
+        self._results = {}
+        self._msgid = 0
+        self._lock = threading.Lock()
+
+    def set_option( self, option, value ):
+        pass
+
+    def _check( self ):
+        if self.uri in DOWN:
+            raise SERVER_DOWN( { 'desc': "Can't contact LDAP server" } )
+
+    def simple_bind_s( self, who='', cred='' ):
+        self._check()
+        return None
+
+    def unbind_s( self ):
+        pass
+
+    def whoami_s( self ):
+        return 'u:fake'
+
+    def abandon( self, msgid ):
+        self._results.pop( msgid, None )
+
+    def _search( self, base, scope, filterstr, attrlist ):
+        test, end = _parse( filterstr )
+        found = []
+        for key, ( dn, attrs ) in sorted( DIRECTORY.iteritems() ):
+            if scope == SCOPE_BASE and key != base.lower():
+                continue
+            if not _under( dn, base ):
+                continue
+            with_dn = dict( attrs, distinguishedName=[ dn ] )
+            if not test( with_dn ):
+                continue
+            if attrlist is not None:
+                wanted = [ a.lower() for a in attrlist ]
+                attrs = dict(
+                    ( a, list( v ) ) for a, v in attrs.iteritems()
+                    if a.lower() in wanted
+                )
+            found.append( ( dn, attrs ) )
+        if scope == SCOPE_BASE and base.lower() not in DIRECTORY:
+            raise NO_SUCH_OBJECT( { 'desc': 'No such object' } )
+        return found
+
+    def search(
+        self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+        attrsonly=0
+    ):
+        self._check()
+        with self._lock:
+            self._msgid += 1
+            msgid = self._msgid
+        self._results[ msgid ] = (
+            time.time() + LATENCY.get( self.uri, 0 ),
+            self._search( base, scope, filterstr, attrlist )
+        )
+        return msgid
+
+    def search_ext(
+        self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+        attrsonly=0, serverctrls=None, clientctrls=None
+    ):
+        return self.search( base, scope, filterstr, attrlist, attrsonly )
+
+    def search_s(
+        self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+        attrsonly=0
+    ):
+        return self._search( base, scope, filterstr, attrlist )
+
+    def _wait( self, msgid, timeout ):
+        # the entries found, or None if a poll (timeout 0) finds the
+        # search still running
+        self._check()
+        due, found = self._results[ msgid ]
+        left = due - time.time()
+        if left > 0:
+            if timeout == 0:
+                return None
+            if timeout is not None and 0 < timeout < left:
+                time.sleep( timeout )
+                raise TIMEOUT( { 'desc': 'Timed out' } )
+            time.sleep( left )
+        del self._results[ msgid ]
+        if self.uri in FAILING:
+            raise SERVER_DOWN( { 'desc': "Can't contact LDAP server" } )
+        return found
+
+    def result( self, msgid=RES_ANY, all=1, timeout=None ):
+        found = self._wait( msgid, timeout )
+        if found is None:
+            return None, None
+        return RES_SEARCH_RESULT, found
+
+    def result3( self, msgid=RES_ANY, all=1, timeout=None ):
+        found = self._wait( msgid, timeout )
+        if found is None:
+            return None, None, None, None
+        # everything fits on one page, so no cookie comes back
+        return RES_SEARCH_RESULT, found, msgid, []
+
+def initialize( uri ):
+    return FakeLDAPObject( uri )
+
+class LDAPControl( object ):
+    def __init__( self, controlType=None, criticality=False, encodedControlValue=None ):
+        self.controlType = controlType
+        self.criticality = criticality
+        self.encodedControlValue = encodedControlValue
+
+class SimplePagedResultsControl( LDAPControl ):
+    controlType = '1.2.840.113556.1.4.319'
+
+    def __init__( self, criticality=False, size=10, cookie='' ):
+        LDAPControl.__init__( self, self.controlType, criticality )
+        self.size = size
+        self.cookie = cookie
+
+def is_dn( s ):
+    return '=' in s
+
+def install():
+    """
+    makes `import ldap` (and ldap.filter, ldap.controls, ldap.dn) find
+    this module's stand-ins
+    """
+    ldap = sys.modules[ __name__ ]
+    submodules = {
+        'filter': { 'escape_filter_chars': escape_filter_chars },
+        'controls': {
+            'LDAPControl': LDAPControl,
+            'SimplePagedResultsControl': SimplePagedResultsControl,
+        },
+        'dn': { 'is_dn': is_dn },
+    }
+    sys.modules[ 'ldap' ] = ldap
+    for name, attrs in submodules.iteritems():
+        module = types.ModuleType( 'ldap.' + name )
+        module.__dict__.update( attrs )
+        setattr( ldap, name, module )
+        sys.modules[ 'ldap.' + name ] = module
@@ -0,0 +1,93 @@
+# -*- coding: UTF-8 -*-
+
+# the app, imported once for every test module, configured to read the
+# in-memory directory in fakeldap
+
+import os
+import sys
+import json
+import atexit
+import shutil
+import tempfile
+
+import fakeldap
+
+TOP = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' )
+BASE = "DC=example,DC=org"
+
+OVERRIDES = """---
+username: bstaff
+mode: a
+alist: [ shared_x ]
+---
+username: cpi
+mode: a
+alist: [ extra_pi ]
+---
+username: rstaff
+mode: r
+alist: [ replaced ]
+---
+username: dstaff
+alist: [ dup_x ]
+"""
+
+_loaded = {}
+
+def person( dn, username, title, sn, given, manager=None, payroll=True ):
+    """
+    adds a user to the directory, with manager's directReports to match
+    """
+    attrs = dict(
+        sAMAccountName=username, sAMAccountType='805306368',
+        objectClass=[ 'top', 'person', 'user' ], title=title, sn=sn,
+        givenName=given, displayName="%s, %s" % ( sn, given )
+    )
+    if payroll:
+        attrs[ 'fhcrcpaygroup' ] = 'Y'
+    if manager is not None:
+        attrs[ 'manager' ] = manager
+        fakeldap.DIRECTORY[ manager.lower() ][1].setdefault(
+            'directReports', []
+        ).append( dn )
+    fakeldap.add( dn, **attrs )
+
+def config():
+    """
+    returns the path of the configuration the app was loaded with
+    """
+    return _loaded[ 'config' ]
+
+def load_app():
+    """
+    imports the app configured to use the in-memory directory
+    """
+    if 'app' in _loaded:
+        return _loaded[ 'app' ]
+    fakeldap.install()
+
+    directory = tempfile.mkdtemp()
+    atexit.register( shutil.rmtree, directory )
+    overrides = os.path.join( directory, 'overrides.yaml' )
+    with open( overrides, 'w' ) as f:
+        f.write( OVERRIDES )
+    path = os.path.join( directory, 'config.json' )
+    with open( path, 'w' ) as f:
+        json.dump( {
+            'SECRET_KEY': 'smoke',
+            'WTF_CSRF_ENABLED': False,
+            'MAXTRIES': 7,
+            'PI_TITLES': [ 'PI Title' ],
+            'OVERRIDES': overrides,
+            'LDAP_SERVER': [ 'ldap://fake' ],
+            'LDAP_SEARCH_BASE': BASE,
+            'BINDDN': 'cn=bind',
+            'BINDPW': 'secret',
+            'LOG_LEVEL': 'WARNING',
+        }, f )
+    os.environ[ 'MAPACCOUNT_CONFIG' ] = path
+    sys.path.insert( 0, TOP )
+    from app import app
+    _loaded[ 'app' ] = app
+    _loaded[ 'config' ] = path
+    return app
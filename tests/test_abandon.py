@@ -0,0 +1,54 @@
+# -*- coding: UTF-8 -*-
+
+# searches given up on are abandoned before the connection is returned
+
+import unittest
+
+import fakeldap
+import support
+
+class Stalled( object ):
+    # a connection whose searches never answer in time
+    def __init__( self ):
+        self.abandoned = []
+
+    def result( self, msgid, all=1, timeout=None ):
+        raise fakeldap.TIMEOUT( { 'desc': 'timed out' } )
+
+    def abandon( self, msgid ):
+        self.abandoned.append( msgid )
+
+class AbandonTest( unittest.TestCase ):
+    def setUp( self ):
+        support.load_app()
+        from app import mapaccount, deadline
+        self.mapaccount = mapaccount
+        self.deadline = deadline
+        self.connection = Stalled()
+
+    def test_timeout( self ):
+        with self.deadline.use( None ):
+            self.assertRaises(
+                fakeldap.TIMEOUT, self.mapaccount._result, self.connection, 3
+            )
+        self.assertEqual( self.connection.abandoned, [ 3 ] )
+
+    def test_deadline( self ):
+        with self.deadline.use( self.deadline.Deadline( 0 ) ):
+            self.assertRaises(
+                self.deadline.DeadlineExceeded,
+                self.mapaccount._result, self.connection, 4
+            )
+        self.assertEqual( self.connection.abandoned, [ 4 ] )
+
+    def test_abandon_fails( self ):
+        def abandon( msgid ):
+            raise fakeldap.SERVER_DOWN( { 'desc': 'gone' } )
+        self.connection.abandon = abandon
+        with self.deadline.use( None ):
+            self.assertRaises(
+                fakeldap.TIMEOUT, self.mapaccount._result, self.connection, 5
+            )
+
+if __name__ == '__main__':
+    unittest.main()
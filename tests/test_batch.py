@@ -0,0 +1,79 @@
+# -*- coding: UTF-8 -*-
+
+# batch chunks on the shared workers, each with its own deadline
+
+import json
+import time
+import threading
+import unittest
+
+import support
+
+class BatchTest( unittest.TestCase ):
+    def setUp( self ):
+        support.load_app()
+        from app import mapaccount, deadline
+        from app.jobs import WorkerPool
+        self.mapaccount = mapaccount
+        self.deadline = deadline
+        self.saved = mapaccount.resolve_uids, mapaccount.batch_workers
+        mapaccount.resolve_uids = self.resolve
+        mapaccount.batch_workers = WorkerPool( 2, 'test-batch' )
+        self.threads = set()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def tearDown( self ):
+        self.mapaccount.resolve_uids, self.mapaccount.batch_workers = self.saved
+
+    def resolve( self, uids ):
+        with self.lock:
+            self.threads.add( threading.current_thread().name )
+            self.calls += 1
+        time.sleep( 0.05 )
+        self.deadline.check()
+        return dict( ( uid, [ uid + '_a' ] ) for uid in uids )
+
+    def batch( self, uids, concurrency=1, seconds=None ):
+        return [
+            json.loads( line ) for line in self.mapaccount.stream_batch(
+                uids, concurrency, 1, seconds
+            )
+        ]
+
+    def test_deadline_per_chunk( self ):
+        # the batch takes longer than one deadline; no chunk does
+        lines = self.batch( [ 'u%s' % n for n in range( 5 ) ], seconds=0.2 )
+        self.assertEqual( len( lines ), 5 )
+        self.assertEqual( [ l for l in lines if 'error' in l ], [] )
+
+    def test_shared_workers( self ):
+        results = []
+        def run( prefix ):
+            results.append( self.batch(
+                [ '%s%s' % ( prefix, n ) for n in range( 4 ) ], 2
+            ) )
+        batches = [
+            threading.Thread( target=run, args=( p, ) ) for p in 'abc'
+        ]
+        for t in batches:
+            t.start()
+        for t in batches:
+            t.join( 10 )
+        self.assertEqual( sorted( len( r ) for r in results ), [ 4, 4, 4 ] )
+        self.assertEqual(
+            self.threads, set( [ 'test-batch-0', 'test-batch-1' ] )
+        )
+
+    def test_client_gone( self ):
+        lines = self.mapaccount.stream_batch(
+            [ 'u%s' % n for n in range( 10 ) ], 1, 1
+        )
+        next( lines )
+        lines.close()
+        time.sleep( 0.2 )
+        # the chunk answered, and at most the one submitted after it
+        self.assertTrue( self.calls <= 2 )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: UTF-8 -*-
+
+# jobs polled on a process other than the one running them
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from support import TOP
+
+sys.path.insert( 0, os.path.join( TOP, 'app' ) )
+from jobs import JobQueue, JobStore
+
+class JobStoreTest( unittest.TestCase ):
+    def setUp( self ):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join( self.directory, 'jobs.db' )
+        self.release = threading.Event()
+
+    def tearDown( self ):
+        self.release.set()
+        shutil.rmtree( self.directory )
+
+    def resolve( self, uids ):
+        self.release.wait( 10 )
+        return dict( ( uid, [ uid + '_a' ] ) for uid in uids )
+
+    def wait( self, queue, id, state ):
+        for n in range( 500 ):
+            job = queue.get( id )
+            if job is not None and job.state == state:
+                return job
+            time.sleep( 0.01 )
+        self.fail( "job %s never reached %s" % ( id, state ) )
+
+    def test_other_process_polls( self ):
+        running = JobQueue(
+            self.resolve, workers=1, chunk=2, store=JobStore( self.path )
+        )
+        # another worker process: same store, its own memory
+        other = JobQueue( self.resolve, store=JobStore( self.path ) )
+
+        job = running.submit( [ 'a', 'b', 'c' ] )
+        self.assertEqual( other.get( job.id ).status()[ 'total' ], 3 )
+        self.wait( other, job.id, 'running' )
+
+        self.release.set()
+        done = self.wait( other, job.id, 'done' )
+        self.assertEqual( done.status(), {
+            'id': job.id, 'state': 'done', 'total': 3, 'done': 3
+        } )
+        self.assertEqual( done.results, {
+            'a': [ 'a_a' ], 'b': [ 'b_a' ], 'c': [ 'c_a' ]
+        } )
+        self.assertEqual( other.stats(), { 'done': 1 } )
+
+    def test_without_store( self ):
+        running = JobQueue( self.resolve, workers=1 )
+        other = JobQueue( self.resolve )
+        job = running.submit( [ 'a' ] )
+        self.assertIsNotNone( running.get( job.id ) )
+        self.assertIsNone( other.get( job.id ) )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+# -*- coding: UTF-8 -*-
+
+# which searches feed the server latency the pool routes by, and how
+# searches are routed, ejected and hedged across two servers
+
+import time
+import unittest
+
+import fakeldap
+import support
+from support import BASE, person
+
+OU = "OU=Pool," + BASE
+
+class LatencyTest( unittest.TestCase ):
+    def setUp( self ):
+        support.load_app()
+        from app.ldappool import LDAPServers, paged_search
+        self.paged_search = paged_search
+        self.servers = LDAPServers(
+            [ 'ldap://one' ], 'cn=bind', 'secret',
+            initialize=fakeldap.initialize
+        )
+        person( "CN=Pool,%s" % OU, 'pool', 'Tech', 'Pool', 'P' )
+
+    def samples( self ):
+        return len( self.servers.selector._samples[ 'ldap://one' ] )
+
+    def test_plain_search_recorded( self ):
+        with self.servers.connection() as l:
+            l.result( l.search( OU, fakeldap.SCOPE_SUBTREE ), 1, 10 )
+        self.assertEqual( self.samples(), 1 )
+
+    def test_paged_search_not_recorded( self ):
+        with self.servers.connection() as l:
+            found = list( self.paged_search(
+                l, OU, fakeldap.SCOPE_SUBTREE, '(objectClass=*)', None
+            ) )
+        self.assertEqual( len( found ), 1 )
+        self.assertEqual( self.samples(), 0 )
+        self.assertIsNone(
+            self.servers.selector.stats()[ 'ldap://one' ][ 'ewma' ]
+        )
+
+ONE = 'ldap://one'
+TWO = 'ldap://two'
+
+class TwoServerTest( unittest.TestCase ):
+    def setUp( self ):
+        support.load_app()
+        from app import ldappool
+        self.ldappool = ldappool
+        person( "CN=Pool,%s" % OU, 'pool', 'Tech', 'Pool', 'P' )
+
+    def tearDown( self ):
+        fakeldap.LATENCY.clear()
+        fakeldap.DOWN.clear()
+        fakeldap.FAILING.clear()
+
+    def servers( self, **args ):
+        return self.ldappool.LDAPServers(
+            [ ONE, TWO ], 'cn=bind', 'secret',
+            initialize=fakeldap.initialize, **args
+        )
+
+    def hedging( self, **args ):
+        # ONE ranked first, hedged once a search has run 50ms
+        servers = self.servers( hedge_percentile=90, **args )
+        for n in range( 20 ):
+            servers.selector.record( ONE, 0.05 )
+            servers.selector.record( TWO, 0.06 )
+        return servers
+
+    def search( self, servers, timeout=10 ):
+        with servers.connection() as l:
+            self.assertEqual( l.server, ONE )
+            return l.result( l.search( OU, fakeldap.SCOPE_SUBTREE ), 1, timeout )
+
+    def ejected( self, servers, server ):
+        return servers.selector.stats()[ server ][ 'ejected' ]
+
+    def winners( self ):
+        return dict(
+            ( winner, self.ldappool.hedged._values.get( ( winner, ), 0 ) )
+            for winner in ( 'primary', 'hedge', 'timeout' )
+        )
+
+    def test_routes_to_faster( self ):
+        fakeldap.LATENCY[ ONE ] = 0.05
+        servers = self.servers()
+        for n in range( 4 ):
+            with servers.connection() as l:
+                l.result( l.search( OU, fakeldap.SCOPE_SUBTREE ), 1, 10 )
+        for n in range( 3 ):
+            with servers.connection() as l:
+                self.assertEqual( l.server, TWO )
+
+    def test_ejects_and_readmits( self ):
+        fakeldap.DOWN.add( ONE )
+        servers = self.servers( eject=0.2 )
+        with servers.connection() as l:
+            self.assertEqual( l.server, TWO )
+        self.assertTrue( self.ejected( servers, ONE ) )
+        self.assertFalse( self.ejected( servers, TWO ) )
+
+        fakeldap.DOWN.clear()
+        time.sleep( 0.25 )
+        self.assertFalse( self.ejected( servers, ONE ) )
+        with servers.connection() as l:
+            self.assertEqual( l.server, ONE )
+
+    def test_ejects_in_use( self ):
+        servers = self.servers()
+        def search():
+            with servers.connection() as l:
+                fakeldap.DOWN.add( l.server )
+                l.search( OU, fakeldap.SCOPE_SUBTREE )
+        self.assertRaises( fakeldap.SERVER_DOWN, search )
+        self.assertTrue( self.ejected( servers, ONE ) )
+        self.assertFalse( self.ejected( servers, TWO ) )
+
+    def test_primary_wins( self ):
+        fakeldap.LATENCY.update( { ONE: 0.1, TWO: 1 } )
+        servers = self.hedging()
+        before = self.winners()
+        started = time.time()
+        type, found = self.search( servers )
+        self.assertTrue( time.time() - started < 0.5 )
+        self.assertEqual( len( found ), 1 )
+        self.assertEqual( self.winners()[ 'primary' ], before[ 'primary' ] + 1 )
+
+    def test_hedge_wins( self ):
+        fakeldap.LATENCY.update( { ONE: 1, TWO: 0 } )
+        servers = self.hedging()
+        before = self.winners()
+        started = time.time()
+        type, found = self.search( servers )
+        self.assertTrue( time.time() - started < 0.5 )
+        self.assertEqual( len( found ), 1 )
+        self.assertEqual( self.winners()[ 'hedge' ], before[ 'hedge' ] + 1 )
+
+    def test_hedge_server_down( self ):
+        fakeldap.LATENCY[ ONE ] = 0.1
+        fakeldap.DOWN.add( TWO )
+        servers = self.hedging()
+        type, found = self.search( servers )
+        self.assertEqual( len( found ), 1 )
+        self.assertFalse( self.ejected( servers, ONE ) )
+        self.assertTrue( self.ejected( servers, TWO ) )
+
+    def test_hedge_server_busy( self ):
+        fakeldap.LATENCY[ ONE ] = 0.1
+        servers = self.hedging( size=1, timeout=5 )
+        held = servers.pools[ TWO ].acquire()
+        try:
+            started = time.time()
+            type, found = self.search( servers )
+        finally:
+            servers.pools[ TWO ].release( held )
+        self.assertTrue( time.time() - started < 1 )
+        self.assertEqual( len( found ), 1 )
+        self.assertFalse( self.ejected( servers, TWO ) )
+
+    def test_primary_fails( self ):
+        fakeldap.LATENCY.update( { ONE: 0.1, TWO: 1 } )
+        fakeldap.FAILING.add( ONE )
+        servers = self.hedging()
+        started = time.time()
+        self.assertRaises( fakeldap.SERVER_DOWN, self.search, servers )
+        self.assertTrue( time.time() - started < 0.5 )
+        self.assertTrue( self.ejected( servers, ONE ) )
+        self.assertFalse( self.ejected( servers, TWO ) )
+
+    def test_timeout_from_result( self ):
+        fakeldap.LATENCY.update( { ONE: 0.6, TWO: 2 } )
+        servers = self.hedging()
+        with servers.connection() as l:
+            msgid = l.search( OU, fakeldap.SCOPE_SUBTREE )
+            time.sleep( 0.3 )
+            # answers 0.3s in, inside the 0.5s asked for
+            type, found = l.result( msgid, 1, 0.5 )
+        self.assertEqual( len( found ), 1 )
+
+    def test_hedged_timeout( self ):
+        fakeldap.LATENCY.update( { ONE: 1, TWO: 1 } )
+        servers = self.hedging()
+        started = time.time()
+        self.assertRaises( fakeldap.TIMEOUT, self.search, servers, 0.2 )
+        self.assertTrue( 0.2 <= time.time() - started < 0.6 )
+        self.assertFalse( self.ejected( servers, ONE ) )
+        self.assertFalse( self.ejected( servers, TWO ) )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# -*- coding: UTF-8 -*-
+
+# the published shared map read back the way the snapshot holds it
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+from support import BASE
+
+PI = "CN=Pe\xc3\xb1a\\, Jos\xc3\xa9,OU=Map," + BASE
+STAFF = "CN=Staff\\, Sam,OU=Map," + BASE
+
+def entries():
+    return [
+        ( PI, {
+            'sAMAccountName': [ 'jpena' ], 'title': [ 'PI Title' ],
+            'sn': [ 'Pe\xc3\xb1a' ], 'givenName': [ 'Jos\xc3\xa9' ],
+            'fhcrcpaygroup': [ 'Y' ],
+        } ),
+        ( STAFF, {
+            'sAMAccountName': [ 'sstaff' ], 'title': [ 'Tech' ],
+            'sn': [ 'Staff' ], 'givenName': [ 'Sam' ], 'manager': [ PI ],
+            'fhcrcpaygroup': [ 'Y' ],
+        } ),
+    ]
+
+class SharedMapTest( unittest.TestCase ):
+    def setUp( self ):
+        support.load_app()
+        from app import sharedmap
+        from app.mapaccount import SHARED_ATTRS
+        from app.snapshot import Snapshot
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join( self.directory, 'map' )
+        self.snapshot = Snapshot( entries(), [ 'PI Title' ], 7, 1 )
+        sharedmap.publish( path, self.snapshot, SHARED_ATTRS )
+        self.mapped = sharedmap.MappedSnapshot( path )
+
+    def tearDown( self ):
+        shutil.rmtree( self.directory )
+
+    def test_values_are_str( self ):
+        attrs = self.mapped.attrs( STAFF )
+        self.assertEqual( attrs[ 'manager' ], [ PI ] )
+        self.assertIsInstance( attrs[ 'manager' ][0], str )
+        self.assertEqual(
+            self.mapped.lookup( 'sstaff' ), self.snapshot.lookup( 'sstaff' )
+        )
+
+    def test_hierarchy( self ):
+        from app.hierarchy import Hierarchy
+        for source in ( self.snapshot, self.mapped ):
+            index = Hierarchy.from_entries(
+                source.iterentries(), [ 'PI Title' ]
+            )
+            self.assertTrue( index.is_under( STAFF, PI ) )
+            self.assertEqual( index.pi_of( STAFF ), PI.lower() )
+            self.assertEqual( index.reports( PI ), [ STAFF.lower() ] )
+
+if __name__ == '__main__':
+    unittest.main()
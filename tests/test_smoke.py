@@ -0,0 +1,73 @@
+# -*- coding: UTF-8 -*-
+
+# requests through app.test_client() against an in-memory directory;
+# run from the top of the tree with
+#
+#     python -m unittest discover tests
+
+import json
+import unittest
+
+import support
+from support import BASE, person
+
+PI = "CN=Pi\\, Ann,OU=Staff," + BASE
+STAFF = "CN=Staff\\, Bob,OU=Staff," + BASE
+
+class SmokeTest( unittest.TestCase ):
+    @classmethod
+    def setUpClass( cls ):
+        cls.app = support.load_app()
+        person( PI, 'api', 'PI Title', 'Pi', 'Ann' )
+        person( STAFF, 'bstaff', 'Technician', 'Staff', 'Bob', manager=PI )
+        cls.client = cls.app.test_client()
+
+    def get_json( self, response ):
+        return json.loads( response.get_data() )
+
+    def test_rest_report( self ):
+        response = self.client.get( '/rest/bstaff' )
+        self.assertEqual( response.status_code, 200 )
+        self.assertEqual(
+            self.get_json( response ), { 'bstaff': [ 'pi_a', 'shared_x' ] }
+        )
+        self.assertIn( 'ETag', response.headers )
+
+    def test_rest_pi( self ):
+        response = self.client.get( '/rest/api' )
+        self.assertEqual( response.status_code, 200 )
+        self.assertEqual( self.get_json( response ), { 'api': [ 'pi_a' ] } )
+
+    def test_rest_unknown( self ):
+        response = self.client.get( '/rest/nobody' )
+        self.assertEqual( response.status_code, 200 )
+        self.assertEqual( self.get_json( response ), { 'nobody': [] } )
+
+    def test_rest_etag( self ):
+        etag = self.client.get( '/rest/api' ).headers[ 'ETag' ]
+        response = self.client.get(
+            '/rest/api', headers={ 'If-None-Match': etag }
+        )
+        self.assertEqual( response.status_code, 304 )
+
+    def test_rest_timeout( self ):
+        response = self.client.get( '/rest/bstaff?timeout=0' )
+        self.assertEqual( response.status_code, 504 )
+        self.assertEqual( self.get_json( response ), { 'bstaff': None } )
+
+    def test_form_get( self ):
+        response = self.client.get( '/form' )
+        self.assertEqual( response.status_code, 200 )
+
+    def test_form_post( self ):
+        response = self.client.post(
+            '/form', data={ 'uids': 'bstaff, api' }
+        )
+        self.assertEqual( response.status_code, 200 )
+        self.assertEqual( self.get_json( response ), {
+            'bstaff': [ 'pi_a', 'shared_x' ],
+            'api': [ 'pi_a' ],
+        } )
+
+if __name__ == '__main__':
+    unittest.main()
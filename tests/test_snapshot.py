@@ -0,0 +1,119 @@
+# -*- coding: UTF-8 -*-
+
+# snapshot answers against the live lookup
+
+import unittest
+
+import fakeldap
+import support
+from support import BASE, person
+
+OU = "OU=Snapshot," + BASE
+
+def dn( name ):
+    return "CN=%s,%s" % ( name, OU )
+
+class Fixed( object ):
+    # stands in for the SnapshotRefresher
+    def __init__( self, snapshot ):
+        self.current = snapshot
+
+    def snapshot( self ):
+        return self.current
+
+class Untouched( object ):
+    # a shared map that must only be looked at
+    def __init__( self, snapshot ):
+        self.current = snapshot
+
+    def snapshot( self ):
+        raise AssertionError( "scrape refreshed the shared map" )
+
+class Generation( object ):
+    def __init__( self, generation ):
+        self.generation = generation
+
+class SnapshotTest( unittest.TestCase ):
+    @classmethod
+    def setUpClass( cls ):
+        support.load_app()
+        from app import mapaccount
+        from app.snapshot import Snapshot
+        cls.mapaccount = mapaccount
+
+        person( dn( 'Boss' ), 'sboss', 'PI Title', 'Boss', 'Bea' )
+        person( dn( 'One' ), 'bstaff2', 'Tech', 'One', 'O', dn( 'Boss' ) )
+        # two payroll entries share a username
+        person( dn( 'Dup A' ), 'dstaff', 'Tech', 'A', 'A', dn( 'Boss' ) )
+        person( dn( 'Dup B' ), 'dstaff', 'Tech', 'B', 'B', dn( 'Boss' ) )
+
+        cls.snapshot = Snapshot(
+            [ entry for key, entry in sorted( fakeldap.DIRECTORY.items() )
+              if key.endswith( OU.lower() ) ],
+            [ 'PI Title' ], 7
+        )
+
+    def lookup( self, uid, snapshot ):
+        mapaccount = self.mapaccount
+        snapshots = mapaccount.snapshots
+        mapaccount.snapshots = Fixed( snapshot ) if snapshot is not None else None
+        try:
+            return mapaccount.map_uid( [ uid ] )
+        finally:
+            mapaccount.snapshots = snapshots
+
+    def test_duplicates_left_to_live( self ):
+        self.assertIsNone( self.snapshot.lookup( 'dstaff' ) )
+        # more than one match: overrides only
+        self.assertEqual(
+            self.lookup( 'dstaff', None ), { 'dstaff': [ 'dup_x' ] }
+        )
+        self.assertEqual(
+            self.lookup( 'dstaff', self.snapshot ), { 'dstaff': [ 'dup_x' ] }
+        )
+
+    def test_answers( self ):
+        for uid in ( 'sboss', 'bstaff2' ):
+            self.assertIsNotNone( self.snapshot.lookup( uid ), uid )
+            self.assertEqual(
+                self.lookup( uid, self.snapshot ), self.lookup( uid, None ), uid
+            )
+
+    def test_new_generation_drops_pi_cache( self ):
+        mapaccount = self.mapaccount
+        pi_cache = mapaccount.pi_cache
+        snapshots = mapaccount.snapshots
+        try:
+            mapaccount.snapshots = Fixed( Generation( 101 ) )
+            mapaccount.current_snapshot()
+            pi_cache.compress( [ dn( 'Boss' ) ], [ 'boss_b' ], 1 )
+            generation = pi_cache.generation
+
+            mapaccount.current_snapshot()
+            self.assertEqual( pi_cache.generation, generation )
+            self.assertIsNotNone( pi_cache.get( dn( 'Boss' ), 7 ) )
+
+            mapaccount.snapshots.current = Generation( 102 )
+            mapaccount.current_snapshot()
+            self.assertEqual( pi_cache.generation, generation + 1 )
+            self.assertIsNone( pi_cache.get( dn( 'Boss' ), 7 ) )
+        finally:
+            mapaccount.snapshots = snapshots
+
+    def test_age_scrape_loads_nothing( self ):
+        mapaccount = self.mapaccount
+        from app import metrics
+        gauge = [ g for g in metrics.REGISTRY
+                  if g.name == 'mapaccount_snapshot_age_seconds' ][0]
+        saved = mapaccount.snapshots, mapaccount.shared_map
+        try:
+            mapaccount.snapshots = None
+            mapaccount.shared_map = Untouched( None )
+            self.assertEqual( len( gauge.render() ), 2 )
+            mapaccount.shared_map = Untouched( self.snapshot )
+            self.assertEqual( len( gauge.render() ), 3 )
+        finally:
+            mapaccount.snapshots, mapaccount.shared_map = saved
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# -*- coding: UTF-8 -*-
+
+# the mapping store idmgr writes must answer as the live lookup would
+
+import os
+import sys
+import runpy
+import logging
+import shutil
+import tempfile
+import unittest
+
+from StringIO import StringIO
+
+import support
+from support import BASE, TOP, person
+
+OU = "OU=Store," + BASE
+
+def dn( name ):
+    return "CN=%s,%s" % ( name, OU )
+
+class StoreTest( unittest.TestCase ):
+    @classmethod
+    def setUpClass( cls ):
+        support.load_app()
+        from app import mapaccount
+        from app.store import MappingStore
+        cls.mapaccount = mapaccount
+
+        person( dn( 'Top' ), 'ttop', 'PI Title', 'Top', 'Tina' )
+        # a PI under another PI, and one with an appending override
+        person( dn( 'Nest' ), 'npi', 'PI Title', 'Nest', 'Ned', dn( 'Top' ) )
+        person( dn( 'Cee' ), 'cpi', 'PI Title', 'Cee', 'Carl', dn( 'Top' ) )
+        person( dn( 'NStaff' ), 'nstaff', 'Tech', 'N', 'S', dn( 'Nest' ) )
+        person( dn( 'TStaff' ), 'tstaff', 'Tech', 'T', 'S', dn( 'Top' ) )
+        # replacing override, and someone off payroll
+        person( dn( 'RStaff' ), 'rstaff', 'Tech', 'R', 'S', dn( 'Top' ) )
+        person(
+            dn( 'Unpaid' ), 'unpaid', 'Tech', 'U', 'P', dn( 'Top' ),
+            payroll=False
+        )
+        # m1 is one manager below ttop, m8 eight- past MAXTRIES
+        manager = dn( 'Top' )
+        for n in range( 1, 9 ):
+            person( dn( 'M%s' % n ), 'm%s' % n, 'Tech', 'M', 'X', manager )
+            manager = dn( 'M%s' % n )
+
+        cls.directory = tempfile.mkdtemp()
+        path = os.path.join( cls.directory, 'mapping.db' )
+        argv, stdout = sys.argv, sys.stdout
+        level = logging.getLogger().level
+        sys.argv = [
+            'idmgr.py', '--config', support.config(), '--store', path, 'all'
+        ]
+        sys.stdout = StringIO()
+        try:
+            runpy.run_path(
+                os.path.join( TOP, 'bin', 'idmgr.py' ), run_name='__main__'
+            )
+        finally:
+            sys.argv, sys.stdout = argv, stdout
+            logging.getLogger().setLevel( level )
+        cls.store = MappingStore( path )
+
+    @classmethod
+    def tearDownClass( cls ):
+        shutil.rmtree( cls.directory )
+
+    def lookup( self, uid, store ):
+        self.mapaccount.mapping_store = store
+        try:
+            return self.mapaccount.map_uid( [ uid ] )
+        finally:
+            self.mapaccount.mapping_store = None
+
+    def test_stored( self ):
+        for uid in ( 'ttop', 'npi', 'cpi', 'nstaff', 'tstaff', 'rstaff',
+                     'm1', 'm7' ):
+            self.assertIsNotNone( self.store.lookup( uid ), uid )
+
+    def test_left_to_live( self ):
+        for uid in ( 'unpaid', 'm8' ):
+            self.assertIsNone( self.store.lookup( uid ), uid )
+
+    def test_answers( self ):
+        expected = {
+            'ttop': { 'ttop': [ 'top_t' ] },
+            'npi': { 'npi': [ 'nest_n' ] },
+            'cpi': { 'cpi': [ 'cee_c' ] },
+            'nstaff': { 'nstaff': [ 'nest_n' ] },
+            'tstaff': { 'tstaff': [ 'top_t' ] },
+            'rstaff': { 'rstaff': [ 'top_t', 'replaced' ] },
+            'unpaid': { 'unpaid': [] },
+            'm7': { 'm7': [ 'top_t' ] },
+            'm8': {},
+        }
+        for uid, answer in expected.iteritems():
+            self.assertEqual( self.lookup( uid, None ), answer, uid )
+            self.assertEqual( self.lookup( uid, self.store ), answer, uid )
+
+if __name__ == '__main__':
+    unittest.main()